@@ -0,0 +1,199 @@
+"""
+Active scheduling of the games of a group.
+
+Every pair of a group is ranked like in bayes_ranker (both teams start from a Beta(2, 2) and are
+separated when their HDIs stop overlapping), but instead of playing the pairs one after the other
+until each is separated, a short round robin is played and the next games always go to the pair
+which needs them most:
+    overlap: The pair whose HDIs overlap the most
+    information: The pair whose HDI overlap is expected to shrink the most with one more game
+The group stops when every pair is separated or cannot be separated anymore: it has played the
+pg + mt games bayes_ranker allows a pair, or its HDIs would still overlap if the leading team won
+all its remaining games. Pairs still overlapping then get a decisive game.
+
+A Budget caps the total number of games of a tournament. Each group gets a share of the games
+left when it starts, in proportion to its number of pairs, spends it on its most uncertain pairs
+and gives back what it did not use; once its share is spent, the pairs of the group which are not
+separated are draws.
+"""
+
+import threading
+
+import bayes_ranker as br
+import team
+
+class Budget():
+    def __init__(self, games=None, pairs=1, parent=None):
+        """
+        Budget constructor:
+            games: Total number of games which can be played, None for no limit (int)
+            pairs: Number of pairs sharing the budget (int)
+            parent: Budget the games left are given back to on release (Budget)
+        """
+        self.games = games
+        self.pairs = pairs
+        self.parent = parent
+        self.lock = threading.Lock()
+
+    def share(self, pairs):
+        """
+        Return the budget of a group of pairs pairs: its share of the games left among the pairs which did not start (Budget)
+        """
+
+        with self.lock:
+            if self.games is None:
+                return Budget(None, pairs, self)
+            games = self.games * pairs // max(self.pairs, pairs, 1)
+            self.games -= games
+            self.pairs -= pairs
+
+            return Budget(games, pairs, self)
+
+    def release(self):
+        #Give the games left back to the parent budget
+        with self.lock:
+            games, self.games = self.games, 0
+        if self.parent is not None:
+            self.parent.give_back(games)
+
+    def take(self, number_games):
+        """
+        Return the number of games, at most number_games, which can still be played (int)
+        """
+
+        with self.lock:
+            if self.games is None:
+                return number_games
+            granted = min(number_games, self.games)
+            self.games -= granted
+
+            return granted
+
+    def give_back(self, number_games):
+        #Games taken but not played
+        with self.lock:
+            if self.games is not None:
+                self.games += number_games
+
+def overlap(team_a, team_b):
+    """
+    Return the length of the intersection of the HDIs of two teams, relative to the shortest HDI (float)
+    """
+
+    common = min(team_a.up_bound, team_b.up_bound) - max(team_a.low_bound, team_b.low_bound)
+
+    return max(common, 0) / min(team_a.up_bound - team_a.low_bound, team_b.up_bound - team_b.low_bound)
+
+def expected_overlap(team_a, team_b):
+    """
+    Return the HDI overlap of two teams expected after one more game between them (float)
+    """
+
+    #Predictive probabilities of a win of each team, the rest being draws
+    p_a = team_a.a / (team_a.a + team_a.b)
+    p_b = team_b.a / (team_b.a + team_b.b)
+    expected = 0
+    for p, won_a, won_b in ((p_a, 1, 0), (p_b, 0, 1), (max(1 - p_a - p_b, 0), 0, 0)):
+        after_a = team.Team(team_a.a + won_a, team_a.b + 1 - won_a, team_a.confidence_mass, "", "")
+        after_b = team.Team(team_b.a + won_b, team_b.b + 1 - won_b, team_b.confidence_mass, "", "")
+        expected += p * overlap(after_a, after_b)
+
+    return expected / max(p_a + p_b + max(1 - p_a - p_b, 0), 1e-12)
+
+def futile(team_a, team_b, remaining):
+    """
+    Return True if the HDIs of two teams would still overlap after the leading team won the remaining games (bool)
+    """
+
+    if team_a.a >= team_b.a:
+        lead, other = team_a, team_b
+    else:
+        lead, other = team_b, team_a
+    best_lead = team.Team(lead.a + remaining, lead.b, lead.confidence_mass, "", "")
+    best_other = team.Team(other.a, other.b + remaining, other.confidence_mass, "", "")
+
+    return team.compare(best_lead, best_other) == 0
+
+def priority(team_a, team_b, rule="information"):
+    """
+    Return how much a pair needs more games under rule ("overlap" or "information"), higher first (float)
+    """
+
+    if rule == "overlap":
+        return overlap(team_a, team_b)
+    if rule == "information":
+        return overlap(team_a, team_b) - expected_overlap(team_a, team_b)
+    raise ValueError("Unknown priority rule: {}".format(rule))
+
+def rank_group(names, paths, backend_for, confidence_mass, first_games, max_games, batch=1, rule="information", budget=None, store=None):
+    """
+    Rank every pair of a group, spending the games on the pairs which need them most:
+        names, paths: Team names and paths to their scripts (list of string)
+        backend_for: Callable backend_for(i, j) returning the backend playing team i (left) against team j (i < j)
+        confidence_mass: HDIs' span (float 0 < x < 1)
+        first_games: Games of each pair in the first round robin (int)
+        max_games: Games a pair can play, decisive game excluded (int)
+        batch: Games given at once to the chosen pair (int)
+        rule: Priority rule of the pairs, "overlap" or "information" (string)
+        budget: Games of the group (Budget, see Budget.share)
+        store: Store recording the results, stored games are reused before simulating new ones (MatchStore)
+
+    Return the (name_l, name_r, winner's name or None) of each pair (list) and the number of games played (int)
+    """
+
+    budget = budget or Budget()
+    pairs = [(i, j) for i in range(len(names)) for j in range(i + 1, len(names))]
+    teams = {p: (team.Team(2, 2, confidence_mass, names[p[0]], paths[p[0]]), team.Team(2, 2, confidence_mass, names[p[1]], paths[p[1]])) for p in pairs}
+    played = {p: 0 for p in pairs}
+    pair_backends = {}
+
+    def play(pair, number_games):
+        #Play up to number_games games of a pair within the budget, return the games played
+        number_games = budget.take(number_games)
+        if number_games == 0:
+            return 0
+        if pair not in pair_backends:
+            pair_backends[pair] = backend_for(*pair)
+        team_a, team_b = teams[pair]
+        games = br.iter_games(team_a.path, team_b.path, number_games, pair_backends[pair], store, (team_a.name, team_b.name), played[pair])
+        score_a, score_b, n = br.update_until_ranked(games, team_a, team_b)
+        budget.give_back(number_games - n)
+        played[pair] += n
+
+        return n
+
+    for pair in pairs:
+        play(pair, min(first_games, max_games))
+    closed = set() #Pairs which cannot be separated anymore
+    while True:
+        open_pairs = []
+        for p in pairs:
+            if p in closed or team.compare(*teams[p]) != 0:
+                continue
+            if played[p] >= max_games or futile(*teams[p], max_games - played[p]):
+                closed.add(p)
+            else:
+                open_pairs.append(p)
+        if not open_pairs:
+            break
+        pair = max(open_pairs, key=lambda p: priority(*teams[p], rule))
+        if play(pair, min(batch, max_games - played[pair])) == 0: #Budget spent, or the games fail
+            break
+    results = []
+    for pair in pairs:
+        team_a, team_b = teams[pair]
+        decision = team.compare(team_a, team_b)
+        if decision == 0 and pair in closed and budget.take(1) == 1: #Too much uncertainty, and the pair cannot be separated anymore
+            if pair not in pair_backends:
+                pair_backends[pair] = backend_for(*pair)
+            score_a, score_b, n = br.generate_game(team_a.path, team_b.path, 1, pair_backends[pair], store, (team_a.name, team_b.name), played[pair])
+            decision = (score_a > score_b) - (score_a < score_b)
+            played[pair] += n
+            budget.give_back(1 - n)
+            print("%s and %s have equivalent performance. Ran a decisive game"%(team_a.name, team_b.name))
+        winner = team_a.name if decision == 1 else team_b.name if decision == -1 else None
+        results.append((team_a.name, team_b.name, winner))
+    budget.release()
+    print("Ranked %d pairs among %d games"%(len(pairs), sum(played.values())))
+
+    return results, sum(played.values())
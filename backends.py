@@ -0,0 +1,161 @@
+"""
+Match backends: where the games of a pairing are played.
+
+A backend plays games between two teams, identified by the path to their script, through
+    backend.play(left_team, right_team, number_games)
+a generator yielding the (match_id, (team_l, team_r), log) identifier, score and log path of each
+game as soon as it is finished (None for games which timed out or failed). Closing the generator
+cancels the games which are not finished yet.
+
+RcssserverBackend plays real RoboCup Simulation 2D games, SyntheticBackend draws scores from
+the latent strengths of the teams so that rankings and tournaments can run at scale without
+a RoboCup install. job_queue.QueueBackend sends the games to distributed workers.
+"""
+
+import json
+import os
+import shutil
+import uuid
+import zlib
+
+import numpy as np
+
+import robocup_utils as rc
+import match_store as ms
+import log_storage
+
+STRENGTH_SCALE = 0.5 #Standard deviation of the latent strengths drawn for unknown teams
+MEAN_GOALS = 1.2 #Expected number of goals of a team facing an opponent of the same strength
+
+class RcssserverBackend():
+    def __init__(self, log_dir, fast_mode=True, workers=1, timeout=None, base_port=None, use_async=False, storage=None):
+        """
+        RcssserverBackend constructor (see robocup_utils.iter_simulations):
+            log_dir: Path to the directory for storing resulting log files (string)
+            fast_mode: Run the server in synchronous (fast) mode (bool)
+            workers: Number of games played simultaneously (int)
+            timeout: Wall-clock limit of each game in seconds (float)
+            base_port: First server port, None for the server default (int)
+            use_async: Play the games with the asyncio rcssserver driver (bool)
+            storage: Storage the logs are moved to after each game, None to move them into log_dir (LogStorage)
+        """
+        self.log_dir = log_dir
+        self.fast_mode = fast_mode
+        self.workers = workers
+        self.timeout = timeout
+        self.base_port = base_port
+        self.use_async = use_async
+        self.storage = storage
+
+    def play(self, left_team, right_team, number_games):
+        games = rc.iter_simulations(left_team, right_team, number_games, self.log_dir, self.fast_mode, self.workers, self.timeout, self.base_port, self.use_async)
+        try:
+            for i, result in games:
+                if result is None:
+                    yield None
+                    continue
+                log, score = result
+                match_id = ms.match_id(log)
+                if self.storage is not None:
+                    log = self.storage.store(log)
+                else:
+                    log = keep_log(log, self.log_dir)
+                yield match_id, score, log
+        finally:
+            games.close()
+
+def keep_log(log, log_dir):
+    """
+    Move a game log out of its private game directory into log_dir and remove the directory
+
+    Return the new path of the log (string)
+    """
+
+    directory = os.path.dirname(log)
+    target = os.path.join(log_dir, os.path.basename(log))
+    if os.path.exists(target): #Simultaneous game with the same date and score
+        target = os.path.join(log_dir, os.path.basename(directory) + "-" + os.path.basename(log))
+    shutil.move(log, target)
+    shutil.rmtree(directory, ignore_errors=True)
+
+    return target
+
+class SyntheticBackend():
+    def __init__(self, strengths=None, seed=None, mean_goals=MEAN_GOALS, stream=None):
+        """
+        SyntheticBackend constructor:
+            strengths: Latent strength of the teams by script path (dict of float)
+            seed: Seed of the latent strengths of unknown teams and of the games (int)
+            mean_goals: Expected number of goals of a team facing an opponent of the same strength (float)
+            stream: Names setting apart the games of backends sharing a seed, such as the round and group of a tournament pairing (tuple of string)
+        Each team scores a Poisson number of goals of mean mean_goals * exp((own - opponent strength) / 2),
+        so stronger teams win more often and teams of close strengths often draw.
+        """
+        self.strengths = dict(strengths or {})
+        self.seed = seed
+        self.mean_goals = mean_goals
+        self.stream = tuple(stream or ())
+        self.generators = {}
+
+    def strength(self, team):
+        """
+        Return the latent strength of a team, drawn once from N(0, STRENGTH_SCALE) if unknown (float)
+        """
+
+        if team not in self.strengths:
+            rng = np.random.default_rng([self.seed or 0, zlib.crc32(team.encode())])
+            self.strengths[team] = float(rng.normal(0, STRENGTH_SCALE))
+
+        return self.strengths[team]
+
+    def scores(self, left_team, right_team, number_games):
+        """
+        Draw the scores of number_games games at once
+
+        Return the goals of the left and right teams (tuple of numpy arrays)
+        """
+
+        key = (left_team, right_team)
+        if key not in self.generators: #One random stream per pairing, reproducible with a seed
+            names = self.stream + key
+            entropy = None if self.seed is None else [self.seed] + [zlib.crc32(name.encode()) for name in names]
+            self.generators[key] = np.random.default_rng(entropy)
+        rng = self.generators[key]
+        difference = (self.strength(left_team) - self.strength(right_team)) / 2
+        #Drawn game after game, so that the stream does not depend on how the games are batched
+        goals = rng.poisson([self.mean_goals * np.exp(difference), self.mean_goals * np.exp(-difference)], (number_games, 2))
+
+        return goals[:, 0], goals[:, 1]
+
+    def skip(self, left_team, right_team, number_games):
+        #Advance the random stream of a pairing past games played earlier (replayed from a journal)
+        self.scores(left_team, right_team, number_games)
+
+    def play(self, left_team, right_team, number_games):
+        goals_l, goals_r = self.scores(left_team, right_team, number_games)
+        for team_l, team_r in zip(goals_l.tolist(), goals_r.tolist()):
+            yield "synthetic-{}".format(uuid.uuid4().hex), (team_l, team_r), None
+
+def load_strengths(path):
+    """
+    Load latent strengths from a JSON file mapping team script paths to floats
+    """
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def make_backend(args):
+    """
+    Build the backend selected by args.backend ("rcssserver", "synthetic" or "queue")
+    """
+
+    if args.backend == "synthetic":
+        strengths = load_strengths(args.strengths) if args.strengths else None
+        return SyntheticBackend(strengths, args.seed, stream=args.stream)
+    if args.backend == "queue":
+        import job_queue #job_queue's workers build their own backends from this module
+        return job_queue.QueueBackend(args.queue, job_queue.resolve_authkey(args.authkey), args.fastm)
+    if args.backend not in (None, "rcssserver"):
+        raise ValueError("Unknown match backend: {}".format(args.backend))
+
+    return RcssserverBackend(args.logdir, args.fastm, args.workers, args.timeout, args.port, args.async_driver, log_storage.from_args(args))
@@ -11,43 +11,128 @@ Additional games are simulated until the teams can be statically ranked.
 Refer to: John K. Kruschke, Bayesian estimation supersedes the t test, Journal of Experimental Psychology: General, May, 2012
 """
 
-import scipy.stats
-import scipy.optimize
 import argparse
-import os
-import glob
-import subprocess
 
-from utils import Dotdict
-import robocup_utils as rc
+from utils import Dotdict, str2bool
+import backends
+import log_storage
+import match_store as ms
+import metrics
+import stopping_table
 import team
 
-def generate_game(left_team, right_team, number_games, fast_mode, log_dir):
+def iter_games(left_team, right_team, number_games, backend, store=None, names=None, offset=0):
     """
-    Run a RoboCup Simulation 2D game involving the two given teams and return
+    Run RoboCup Simulation 2D games involving the two given teams and yield
+    the result of each game as soon as it is known (see generate_game for the arguments).
+    Closing the generator cancels the games which are not finished yet.
+
+    Yield a binary value (1: win, 0: lose or draw) for both left_team and right_team of each
+    game; games which timed out or failed are not evidence and yield nothing
+    """
+
+    def outcome(score):
+        team_l, team_r = score
+
+        return int(team_l > team_r), int(team_l < team_r)
+
+    stored = []
+    if store is not None:
+        key = (names[0], names[1], left_team, right_team)
+        stored = store.results(*key, offset=offset, limit=number_games)
+    metrics.count("stored_games", len(stored))
+    for result in stored:
+        if hasattr(backend, "stored"): #Wrappers recording the games (see evidence.py) see the stored ones too
+            backend.stored(left_team, right_team, result)
+        yield outcome(result[1])
+    remaining = number_games - len(stored)
+    while remaining > 0:
+        replayed = False
+        games = backend.play(left_team, right_team, remaining)
+        try:
+            for result in games:
+                if result is None: #Timed out or failed game
+                    metrics.count("failed_games")
+                    remaining -= 1
+                    continue
+                match_id, score, log = result
+                if store is not None and store.known(match_id): #Replayed by a journal (see journal.py), the store served it already
+                    replayed = True
+                    continue
+                remaining -= 1
+                metrics.count("games")
+                if store is not None:
+                    store.record(*key, match_id, score, log)
+                yield outcome(score)
+        finally:
+            games.close()
+        if not replayed: #Otherwise the games replaced by the replayed ones are still to play
+            break
+
+def generate_game(left_team, right_team, number_games, backend, store=None, names=None, offset=0):
+    """
+    Run RoboCup Simulation 2D games involving the two given teams and return
     the result.
         left_team, right_team: Path to the team's script (string)
+        backend: Backend playing the games (see backends.py)
+        store: Store recording the results, stored games are reused before simulating new ones (MatchStore)
+        names: Names of the left and right teams, used as store keys (tuple of string)
+        offset: Number of games of the pairing already played in this ranking (int)
 
-    Return the number of won games for both left_team and right_team
+    Return the number of won games for both left_team and right_team and the number of games
+    observed, failed games excluded
     """
 
     team_a = 0
     team_b = 0
-    for i in range(number_games):
-        rc.launch_simulation(left_team, right_team, log_dir, fast_mode)
-        #Get the logs of the last (most recent) simulation
-        logs = glob.glob(os.path.join(log_dir, '*.rcg'))
-        latest_log_file = max(logs, key=os.path.getctime)
-        #Get results
-        team_l, team_r = rc.extract_results(latest_log_file)
-        if team_l > team_r:
-            team_a += 1
-        elif team_l < team_r:
-            team_b += 1
-
-    return team_a, team_b
-
-def main(args):
+    observed = 0
+    for won_a, won_b in iter_games(left_team, right_team, number_games, backend, store, names, offset):
+        team_a += won_a
+        team_b += won_b
+        observed += 1
+
+    return team_a, team_b, observed
+
+def update_until_ranked(games, team_a, team_b, table=None):
+    """
+    Update the teams' distributions after each game of a batch and stop as soon as
+    the teams can be ranked, cancelling the remaining games of the batch:
+        games: Results of the games as they arrive (generator from iter_games)
+        table: Precomputed stopping boundaries (StoppingTable)
+
+    Return the number of won games for both teams and the number of games played
+    """
+
+    score_team_a = 0
+    score_team_b = 0
+    played = 0
+    try:
+        for won_a, won_b in games:
+            played += 1
+            score_team_a += won_a
+            score_team_b += won_b
+            team.update_teams([team_a, team_b], 1, [won_a, won_b], table is None)
+            if team.compare(team_a, team_b, table) != 0:
+                break
+    finally:
+        games.close()
+
+    return score_team_a, score_team_b, played
+
+def main(args, backend=None, prior=None):
+    """
+    Rank the teams args.lb and args.rb:
+        backend: Backend playing the games, built from args if None (see backends.py)
+        prior: Earlier evidence (wins of the left team, wins of the right team, games) added to
+               both teams' Beta(2, 2) priors (tuple of float, see evidence.py)
+
+    Return the winner (Team), None for a draw
+    """
+
+    with metrics.timer("ranking"):
+        return rank(args, backend, prior)
+
+def rank(args, backend=None, prior=None):
     #Global variables
     confidence_mass = round(args.cm, 2) #Runtime error occurs on the numpy side for numbers not rounded to 2
     assert (confidence_mass > 0 and confidence_mass < 1), "The confidence mass should be a number between 0 and 1"
@@ -65,36 +150,64 @@ def main(args):
     add = 0
     hist_a = []
     hist_b = []
+    played = 0 #Games observed so far, used to replay stored results in order
+    saved = 0 #Games of the batches cancelled by early stopping
+    store = ms.MatchStore(args.store, args.stage or "") if args.store else None
+    if backend is None:
+        backend = backends.make_backend(args)
+    table = None
+    if args.tables: #Both teams start from a Beta(2, 2)
+        table = stopping_table.load(2, 2, confidence_mass, 2 * prior_games + max_try, args.tables)
 
     #Build the two teams
     team_a = team.Team(2, 2, confidence_mass, args.ln, args.lb)
     team_b = team.Team(2, 2, confidence_mass, args.rn, args.rb)
+    carried = 0
+    if prior is not None: #Games of an earlier pairing of the teams
+        won_a, won_b, carried = prior
+        team.update_teams([team_a, team_b], carried, [won_a, won_b], False)
+
+    names = (team_a.name, team_b.name)
 
     #Make some prior simulations
-    score_team_a, score_team_b = generate_game(team_a.path, team_b.path, args.pg, args.fastm, args.logdir)
+    score_team_a, score_team_b, n = generate_game(team_a.path, team_b.path, args.pg, backend, store, names, played)
+    played += n
     hist_a.append(score_team_a)
     hist_b.append(score_team_b)
-    team_a.update(args.pg, score_team_a)
-    team_b.update(args.pg, score_team_b)
+    team.update_teams([team_a, team_b], n, [score_team_a, score_team_b], table is None)
 
     #Start the ranking algorithm
+    iterations = 0
     while not ranked:
-        if team_a.low_bound > team_b.up_bound: #TeamA > TeamB
+        iterations += 1
+        decision = team.compare(team_a, team_b, table)
+        if decision == 1: #TeamA > TeamB
             winner = team_a
             ranked = True
-        elif team_a.up_bound < team_b.low_bound: #TeamA < TeamB
+        elif decision == -1: #TeamA < TeamB
             winner = team_b
             ranked = True
+        elif games < max_try and args.early_stop: #Too much uncertainty, observe additional games until the teams are ranked
+            batch = iter_games(team_a.path, team_b.path, args.pg, backend, store, names, played)
+            score_team_a, score_team_b, n = update_until_ranked(batch, team_a, team_b, table)
+            played += n
+            hist_a.append(score_team_a)
+            hist_b.append(score_team_b)
+            if team.compare(team_a, team_b, table) != 0: #Ranked before the end of the batch
+                saved += args.pg - n
+                games += n
+            else: #The whole batch was used, failed games included
+                games += args.pg
         elif games < max_try: #Too much uncertainty, observe one additional game
-            score_team_a, score_team_b = generate_game(team_a.path, team_b.path, args.pg, args.fastm, args.logdir)
+            score_team_a, score_team_b, n = generate_game(team_a.path, team_b.path, args.pg, backend, store, names, played)
+            played += n
             hist_a.append(score_team_a)
             hist_b.append(score_team_b)
-            team_a.update(args.pg, score_team_a)
-            team_b.update(args.pg, score_team_b)
+            team.update_teams([team_a, team_b], n, [score_team_a, score_team_b], table is None)
             games += args.pg
         else: #Too much uncertainty, but simulations number limit reached
-            add = 1
-            score_team_a, score_team_b = generate_game(team_a.path, team_b.path, 1, args.fastm, args.logdir)
+            score_team_a, score_team_b, add = generate_game(team_a.path, team_b.path, 1, backend, store, names, played)
+            played += add
             hist_a.append(score_team_a)
             hist_b.append(score_team_b)
             if score_team_a > score_team_b:
@@ -106,16 +219,29 @@ def main(args):
             ranked = True
             print("Teams have equivalent performance. Ran a decisive game")
     print("Evaluated among %d games plus %d additional games"%(games, add))
+    metrics.count("rankings")
+    metrics.observe("iterations_until_ranked", iterations)
+    metrics.observe("games_until_ranked", played)
+    if args.early_stop:
+        print("Early stopping saved %d simulations compared with batches of %d games"%(saved, args.pg))
     if winner != None:
         print("Winner: %s"%(winner.name))
     else:
         print("No winner.")
-    print("%s won %d, %s won %d of %d games"%(team_a.name, team_a.a - 2, team_b.name, team_b.a - 2, (prior_games + games)))
+    print("%s won %d, %s won %d of %d games"%(team_a.name, team_a.a - 2, team_b.name, team_b.a - 2, played - add))
+    if carried:
+        print("Including %g games carried over from an earlier pairing"%(carried))
+    if store is not None:
+        store.close()
 
     return winner
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Rank 2 RoboCup Simulation 2D teams according to Bayesian inference")
+def arguments():
+    """
+    Return the command line parser, its defaults are the settings of a ranking (argparse.ArgumentParser)
+    """
+
+    parser = argparse.ArgumentParser(description="Rank 2 RoboCup Simulation 2D teams according to Bayesian inference", parents=[log_storage.arguments()])
     parser.add_argument("--lb", type=str, default="/home/scom/Documents/robocup/environment/helios-10Singapore/start.sh", help="Path of the left team's script")
     parser.add_argument("--ln", type=str, default="Helios2010", help="Name of the left team")
     parser.add_argument("--rb", type=str, default="/home/scom/Documents/robocup/environment/agent2d-3.1.1/src/start.sh", help="Path of the right team's script")
@@ -127,6 +253,26 @@ if __name__ == '__main__':
     parser.add_argument("--b", type=float, default=2, help="'b' parameter of the prior Beta distribution")
     parser.add_argument("--fastm", type=bool, default=True, help="Boolean controling simulation fast mode")
     parser.add_argument("--logdir", type=str, default="logs", help="Path to the directory for storing resulting log files")
-    args = Dotdict(vars(parser.parse_args()))
+    parser.add_argument("--workers", type=int, default=1, help="Number of games simulated simultaneously")
+    parser.add_argument("--timeout", type=float, default=None, help="Wall-clock limit of a game in seconds")
+    parser.add_argument("--port", type=int, default=None, help="First server port used by simultaneous games (default: the server default)")
+    parser.add_argument("--async_driver", type=str2bool, default=False, help="Run rcssserver and the teams as managed subprocesses on an asyncio event loop")
+    parser.add_argument("--early_stop", type=str2bool, default=False, help="Check the HDIs after each game and cancel the rest of the batch once the teams are ranked")
+    parser.add_argument("--backend", type=str, default="rcssserver", choices=["rcssserver", "synthetic", "queue"], help="Play the games with rcssserver, draw them from the teams' latent strengths or send them to the workers of a job_queue.py coordinator")
+    parser.add_argument("--strengths", type=str, default=None, help="JSON file of the latent strengths of the teams by script path (synthetic backend)")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the synthetic backend")
+    parser.add_argument("--metrics", type=str, default=None, help="Write timings and counters to this file (Prometheus text format if it ends with .prom, JSON otherwise)")
+    parser.add_argument("--queue", type=str, default="127.0.0.1:50000", help="Address host:port of the job_queue.py coordinator (queue backend)")
+    parser.add_argument("--authkey", type=str, default=None, help="Shared secret of the coordinator (queue backend, default: the BAYESRANKING_AUTHKEY environment variable)")
+    parser.add_argument("--store", type=str, default=None, help="Path to the SQLite database recording (and replaying) game results")
+    parser.add_argument("--tables", type=str, default=None, help="Directory of the precomputed stopping tables (see stopping_table.py), HDIs are computed at each iteration if unset")
+
+    return parser
+
+if __name__ == '__main__':
+    args = Dotdict(vars(arguments().parse_args()))
+    if args.metrics:
+        metrics.enable()
     winner = main(args)
-    return winner
+    if args.metrics:
+        metrics.write(args.metrics)
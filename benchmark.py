@@ -0,0 +1,195 @@
+"""
+Benchmarks of the ranking and tournament hot paths.
+
+Times the HDI computation over a grid of (a, b, confidence_mass), the team updates, full
+pairwise rankings (bayes_ranker.main) and complete tournaments (tournament.main) against the
+synthetic match backend instead of rcssserver. Results are written as JSON and, given a
+baseline file from a previous run, compared with it benchmark by benchmark.
+
+Usage: python benchmark.py --output bench.json [--baseline previous_bench.json]
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from utils import Dotdict
+import bayes_ranker as br
+import hdi
+import team
+import tournament
+
+def measure(function, repeat):
+    """
+    Call function repeat times
+
+    Return the best, mean and total wall times in seconds (dict)
+    """
+
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return {"best": min(times), "mean": sum(times) / len(times), "total": sum(times), "repeat": repeat}
+
+def ranking_args(**kwargs):
+    args = Dotdict(lb="left", ln="Left", rb="right", rn="Right", cm=0.95, pg=10, mt=100, a=2, b=2,
+                   fastm=True, logdir="logs", workers=1, timeout=None, port=None, backend="synthetic", seed=0)
+    args.update(kwargs)
+
+    return args
+
+def bench_hdi(repeat):
+    #HDI of every (a, b, cm) of the grid, cache cleared before each run
+    grid = list(itertools.product(np.arange(2, 60, 3), np.arange(2, 60, 3), [0.8, 0.9, 0.95, 0.99]))
+
+    def run():
+        hdi.cache_clear()
+        for a, b, cm in grid:
+            team.Team(a, b, cm, "", "").get_hdi()
+
+    result = measure(run, repeat)
+    result["per_call"] = result["best"] / len(grid)
+
+    return result
+
+def bench_hdi_cached(repeat):
+    #Same grid, every HDI already in the cache
+    grid = list(itertools.product(np.arange(2, 60, 3), np.arange(2, 60, 3), [0.8, 0.9, 0.95, 0.99]))
+    for a, b, cm in grid:
+        hdi.beta_hdi(a, b, cm)
+
+    def run():
+        for a, b, cm in grid:
+            hdi.beta_hdi(a, b, cm)
+
+    result = measure(run, repeat)
+    result["per_call"] = result["best"] / len(grid)
+
+    return result
+
+def bench_hdi_batch(repeat):
+    #Vectorized HDIs of 10000 random posteriors
+    rng = np.random.default_rng(0)
+    a = rng.integers(2, 200, 10000)
+    b = rng.integers(2, 200, 10000)
+    result = measure(lambda: hdi.beta_hdi_batch(a, b, 0.95), repeat)
+    result["per_call"] = result["best"] / len(a)
+
+    return result
+
+def bench_update(repeat):
+    #Sequence of 1000 single game updates of a pair of teams
+    rng = random.Random(0)
+    results = [rng.random() < 0.6 for i in range(1000)]
+
+    def run():
+        hdi.cache_clear()
+        team_a = team.Team(2, 2, 0.95, "A", "")
+        team_b = team.Team(2, 2, 0.95, "B", "")
+        for won in results:
+            team.update_teams([team_a, team_b], 1, [int(won), int(not won)])
+
+    result = measure(run, repeat)
+    result["per_call"] = result["best"] / len(results)
+
+    return result
+
+def bench_ranking(repeat):
+    #50 pairwise rankings against the synthetic backend
+    pairs = [("team_{}".format(i), "team_{}".format(i + 1)) for i in range(50)]
+
+    def run():
+        hdi.cache_clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for left, right in pairs:
+                br.main(ranking_args(lb=left, ln=left, rb=right, rn=right))
+
+    result = measure(run, repeat)
+    result["per_call"] = result["best"] / len(pairs)
+
+    return result
+
+def bench_tournament(repeat):
+    #Complete tournaments/2016.json tournament against the synthetic backend
+    directory = tempfile.mkdtemp()
+    shutil.copytree(os.path.join(os.path.dirname(os.path.abspath(__file__)), "tournaments"), os.path.join(directory, "tournaments"))
+    os.makedirs(os.path.join(directory, "textres"))
+    cwd = os.getcwd()
+
+    def run():
+        hdi.cache_clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            tournament.main(ranking_args(jobs=1))
+
+    os.chdir(directory)
+    try:
+        result = measure(run, repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+    return result
+
+BENCHMARKS = {
+    "hdi": bench_hdi,
+    "hdi_cached": bench_hdi_cached,
+    "hdi_batch": bench_hdi_batch,
+    "update": bench_update,
+    "ranking": bench_ranking,
+    "tournament": bench_tournament,
+}
+
+def compare(results, baseline):
+    """
+    Compare results with a baseline run
+
+    Return the speedup (baseline best time / best time) of each benchmark found in both (dict)
+    """
+
+    speedups = {}
+    for name, result in results.items():
+        if name in baseline.get("results", {}):
+            speedups[name] = baseline["results"][name]["best"] / result["best"]
+
+    return speedups
+
+def main(args):
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    results = {}
+    for name in names:
+        print("Running %s ..."%(name))
+        results[name] = BENCHMARKS[name](args.repeat)
+        print("%s: best %.6f s, mean %.6f s"%(name, results[name]["best"], results[name]["mean"]))
+    report = {"python": platform.python_version(), "numpy": np.__version__, "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            report["speedups"] = compare(results, json.load(f))
+        for name, speedup in sorted(report["speedups"].items()):
+            print("%s: %.2fx %s than baseline"%(name, speedup if speedup >= 1 else 1 / speedup, "faster" if speedup >= 1 else "slower"))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the ranking and tournament hot paths")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each benchmark")
+    parser.add_argument("--only", type=str, default=None, help="Comma separated benchmarks to run (%s)"%(', '.join(BENCHMARKS)))
+    parser.add_argument("--output", type=str, default="bench.json", help="Path of the JSON results")
+    parser.add_argument("--baseline", type=str, default=None, help="Path of previous JSON results to compare with")
+    args = Dotdict(vars(parser.parse_args()))
+    main(args)
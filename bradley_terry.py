@@ -0,0 +1,164 @@
+"""
+Rank all the teams of a group with a joint Bayesian Bradley-Terry model.
+
+Each team i has a latent strength s_i ~ N(0, PRIOR_SD^2) and wins a game against team j with
+probability 1 / (1 + exp(s_j - s_i)); a draw counts as half a win for both teams. The posterior of
+the strengths given every game played in the group is approximated by a Gaussian centred on its
+mode (Laplace approximation), so that the games against common opponents inform every comparison.
+
+A short round robin is played first, then batches of games are played between the two adjacent
+teams (in posterior mean order) whose order is the least certain, until every adjacent pair is
+ordered with probability confidence_mass or has played as many games as bayes_ranker allows a
+pair. Pairs whose order is still uncertain at the end get a decisive game, like in bayes_ranker.
+The games can be drawn from a budget shared by the groups of a tournament (active.Budget): once
+the group's share is spent, the pairs whose order is still uncertain are draws.
+
+Refer to: R. A. Bradley and M. E. Terry, Rank Analysis of Incomplete Block Designs, Biometrika, 1952
+"""
+
+import numpy as np
+import scipy.special
+
+import active
+import bayes_ranker as br
+
+PRIOR_SD = 1.0 #Standard deviation of the prior of the strengths
+MAX_ITER = 50 #Newton iterations of the posterior mode
+TOLERANCE = 1e-9 #Newton step size at which the posterior mode is found
+
+class GroupModel():
+    def __init__(self, names, prior_sd=PRIOR_SD):
+        """
+        GroupModel constructor:
+            names: Team names (list of string)
+            prior_sd: Standard deviation of the Gaussian prior of the strengths (float)
+        """
+        self.names = list(names)
+        self.prior_sd = prior_sd
+        self.wins = np.zeros((len(names), len(names))) #wins[i, j]: games team i won against team j, draws count half
+        self.mean = np.zeros(len(names))
+        self.cov = np.eye(len(names)) * prior_sd ** 2
+
+    def update(self, i, j, won_i, won_j, draws):
+        """
+        Add games between teams i and j and update the posterior
+        """
+        self.wins[i, j] += won_i + draws / 2
+        self.wins[j, i] += won_j + draws / 2
+        self.fit()
+
+    def fit(self):
+        """
+        Compute the Laplace approximation (mean, cov) of the posterior of the strengths
+        """
+        games = self.wins + self.wins.T
+        s = self.mean.copy()
+        for k in range(MAX_ITER):
+            p = scipy.special.expit(s[:, None] - s[None, :])
+            w = games * p * (1 - p)
+            gradient = (self.wins - games * p).sum(axis=1) - s / self.prior_sd ** 2
+            hessian = w - np.diag(w.sum(axis=1) + 1 / self.prior_sd ** 2)
+            step = np.linalg.solve(hessian, gradient)
+            s -= step
+            if np.abs(step).max() < TOLERANCE:
+                break
+        p = scipy.special.expit(s[:, None] - s[None, :])
+        w = games * p * (1 - p)
+        self.mean = s
+        self.cov = np.linalg.inv(np.diag(w.sum(axis=1) + 1 / self.prior_sd ** 2) - w)
+
+    def prob_better(self):
+        """
+        Return the posterior probability that team i is stronger than team j for every i, j (numpy array)
+        """
+
+        var = np.diag(self.cov)
+        spread = np.sqrt(np.maximum(var[:, None] + var[None, :] - 2 * self.cov, 1e-300))
+
+        return scipy.special.ndtr((self.mean[:, None] - self.mean[None, :]) / spread)
+
+    def least_certain(self, confidence_mass, exhausted=()):
+        """
+        Return the adjacent teams (i, j), in posterior mean order, whose order is the least
+        certain, None if every adjacent order is certain with probability confidence_mass (tuple)
+            exhausted: Pairs (min(i, j), max(i, j)) which cannot play anymore and are skipped (set)
+        """
+
+        order = np.argsort(-self.mean)
+        prob = self.prob_better()
+        candidates = []
+        for k in range(len(order) - 1):
+            i, j = int(order[k]), int(order[k + 1])
+            if prob[i, j] < confidence_mass and (min(i, j), max(i, j)) not in exhausted:
+                candidates.append((prob[i, j], i, j))
+        if not candidates:
+            return None
+
+        return min(candidates)[1:]
+
+def rank_group(names, paths, backend_for, confidence_mass, group_games, batch, max_games, store=None, budget=None):
+    """
+    Rank the teams of a group:
+        names, paths: Team names and paths to their scripts (list of string)
+        backend_for: Callable backend_for(i, j) returning the backend playing team i (left) against team j (i < j)
+        confidence_mass: Probability at which the order of two teams is certain (float 0 < x < 1)
+        group_games: Games of each pair in the first round robin (int)
+        batch: Games played at once between the least certain pair (int)
+        max_games: Games a pair can play, decisive game excluded (int)
+        store: Store recording the results, stored games are reused before simulating new ones (MatchStore)
+        budget: Games of the group (active.Budget, see active.Budget.share)
+
+    Return the (name_l, name_r, winner's name or None) of each pair (list) and the number of games played (int)
+    """
+
+    budget = budget or active.Budget()
+    model = GroupModel(names)
+    played = {} #Games played by each pair, used to replay stored results in order
+    pair_backends = {} #Backend of each pair, built when its first game is played
+    pairs = [(i, j) for i in range(len(names)) for j in range(i + 1, len(names))]
+
+    def play(i, j, number_games):
+        #Play up to number_games games of a pair within the budget, return the games won by each team and played
+        won_i = won_j = n = 0
+        number_games = budget.take(number_games)
+        if number_games == 0:
+            return won_i, won_j, n
+        if (i, j) not in pair_backends:
+            pair_backends[(i, j)] = backend_for(i, j)
+        for won_a, won_b in br.iter_games(paths[i], paths[j], number_games, pair_backends[(i, j)], store, (names[i], names[j]), played.get((i, j), 0)):
+            won_i += won_a
+            won_j += won_b
+            n += 1
+        budget.give_back(number_games - n)
+        played[(i, j)] = played.get((i, j), 0) + n
+        model.update(i, j, won_i, won_j, n - won_i - won_j)
+
+        return won_i, won_j, n
+
+    for i, j in pairs:
+        if group_games > 0:
+            play(i, j, group_games)
+    while True:
+        pair = model.least_certain(confidence_mass, set(p for p in pairs if played.get(p, 0) >= max_games))
+        if pair is None:
+            break
+        i, j = min(pair), max(pair)
+        if play(i, j, min(batch, max_games - played.get((i, j), 0)))[2] == 0: #Budget spent, or the games fail
+            break
+    prob = model.prob_better()
+    results = []
+    for i, j in pairs:
+        if prob[i, j] >= confidence_mass:
+            winner = names[i]
+        elif prob[j, i] >= confidence_mass:
+            winner = names[j]
+        else: #Too much uncertainty, but simulations number limit reached
+            won_i, won_j, n = play(i, j, 1)
+            winner = names[i] if won_i > won_j else names[j] if won_j > won_i else None
+            if n > 0:
+                print("%s and %s have equivalent performance. Ran a decisive game"%(names[i], names[j]))
+        results.append((names[i], names[j], winner))
+    budget.release()
+    print("Ranked %d teams among %d games"%(len(names), sum(played.values())))
+
+    return results, sum(played.values())
@@ -0,0 +1,218 @@
+"""
+Long-running ranking daemon.
+
+Keeps scipy, the HDI cache, the stopping tables and the tournament settings loaded between
+requests so that orchestration tools running thousands of short rankings do not pay the
+start-up cost of bayes_ranker.py each time. Requests are JSON lines read from stdin or from
+the connections of a local Unix socket; each one is answered, as soon as it is done, by a JSON
+line carrying the same "id". Requests of a stream run concurrently, so answers may come out of order.
+
+Requests:
+    {"id": 1, "op": "rank", "args": {"lb": ..., "rb": ..., ...}}
+        Rank two teams (bayes_ranker.main), args override the bayes_ranker.py defaults
+        -> {"id": 1, "winner": "name" or null}
+    {"id": 2, "op": "posterior", "a": 2, "b": 2, "wins": 7, "games": 10, "cm": 0.95}
+        Beta(a + wins, b + games - wins) posterior of a team (wins and games default to 0)
+        -> {"id": 2, "a": 9, "b": 5, "mean": ..., "hdi": [low, up]}
+    {"id": 3, "op": "compare", "teams": [[a, b], [a, b]], "cm": 0.95}
+        -> {"id": 3, "decision": 1, 0 or -1} (see team.compare)
+    {"id": 4, "op": "tournament", "args": {...}}
+        Play a tournament (tournament.main), its rankings are written to a directory of its own
+        -> {"id": 4, "ranking": [[name, points], ...], "output": "textres/request_<n>"}
+    {"id": 5, "op": "stats"}
+        -> {"id": 5, "hdi": {...}, "metrics": {...}}
+    {"id": 6, "op": "reload"}
+        Forget the cached HDIs, stopping tables and tournament settings
+Failed requests are answered with {"id": ..., "error": "..."}.
+
+Rankings and tournaments running simultaneously each hold one of the --jobs slots: a slot has its
+own range of SLOT_PORTS server ports (from the requested port, rcssserver default if unset) so that
+their servers never collide.
+
+The rankings' progress messages and the output of the servers and teams go to stderr, stdout only carries the answers.
+
+Usage: python daemon.py [--socket /tmp/bayesranking.sock] [--jobs 4] [--metrics True]
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import itertools
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+
+from utils import Dotdict, str2bool
+import bayes_ranker as br
+import hdi
+import metrics
+import robocup_utils as rc
+import stopping_table
+import team
+import tournament
+
+SLOT_PORTS = 300 #Server ports of a slot (100 simultaneous servers)
+
+class Daemon():
+    def __init__(self, jobs=4):
+        """
+        Daemon constructor:
+            jobs: Number of requests of a stream handled simultaneously (int)
+        """
+        self.jobs = jobs
+        self.ranking_defaults = vars(br.arguments().parse_args([]))
+        self.tournament_defaults = vars(tournament.arguments().parse_args([]))
+        self.slots = queue.Queue()
+        for slot in range(max(jobs, 1)):
+            self.slots.put(slot)
+        self.requests = itertools.count()
+
+    @contextlib.contextmanager
+    def slot(self, args, servers):
+        #Hold a slot for a request using up to servers simultaneous servers, moving its ports to the slot's range
+        assert (servers * rc.PORT_STRIDE <= SLOT_PORTS), "A request can use at most {} simultaneous servers".format(SLOT_PORTS // rc.PORT_STRIDE)
+        slot = self.slots.get()
+        try:
+            args.port = (args.port or rc.DEFAULT_PORT) + slot * SLOT_PORTS
+            yield slot
+        finally:
+            self.slots.put(slot)
+
+    def rank(self, request):
+        args = Dotdict(self.ranking_defaults)
+        args.update(request.get("args", {}))
+        with self.slot(args, max(args.workers or 1, 1)):
+            winner = br.main(args)
+
+        return {"winner": winner.name if winner is not None else None}
+
+    def posterior(self, request):
+        cm = request.get("cm", 0.95)
+        a = request.get("a", 2) + request.get("wins", 0)
+        b = request.get("b", 2) + request.get("games", 0) - request.get("wins", 0)
+        assert (a > 0 and b > 0), "A Beta distribution is only defined for parameters greater than 0"
+
+        return {"a": a, "b": b, "mean": a / (a + b), "hdi": list(hdi.beta_hdi(a, b, cm))}
+
+    def compare(self, request):
+        cm = request.get("cm", 0.95)
+        (a_a, b_a), (a_b, b_b) = request["teams"]
+
+        return {"decision": team.compare(team.Team(a_a, b_a, cm, "", ""), team.Team(a_b, b_b, cm, "", ""))}
+
+    def tournament(self, request):
+        args = Dotdict(self.tournament_defaults)
+        args.update(request.get("args", {}))
+        args.output = os.path.join(args.output or "textres", "request_{}".format(next(self.requests)))
+        with self.slot(args, max(args.jobs or 1, 1) * max(args.workers or 1, 1)):
+            ranking = tournament.main(args)
+
+        return {"ranking": [list(t) for t in ranking], "output": args.output}
+
+    def stats(self, request):
+        info = hdi.cache_info()
+
+        return {"hdi": {"hits": info.hits, "misses": info.misses, "size": info.currsize}, "metrics": metrics.snapshot()}
+
+    def reload(self, request):
+        hdi.cache_clear()
+        stopping_table._loaded.clear()
+        tournament.load_settings.cache_clear()
+
+        return {}
+
+    def handle(self, request):
+        """
+        Answer a request (dict)
+
+        Return the answer (dict)
+        """
+
+        operations = {"rank": self.rank, "posterior": self.posterior, "compare": self.compare,
+                      "tournament": self.tournament, "stats": self.stats, "reload": self.reload}
+        answer = {"id": request.get("id")}
+        try:
+            operation = operations.get(request.get("op"))
+            if operation is None:
+                raise ValueError("Unknown operation: {}".format(request.get("op")))
+            answer.update(operation(request))
+        except Exception as e:
+            answer["error"] = "{}: {}".format(type(e).__name__, e)
+
+        return answer
+
+    def serve(self, lines, write):
+        """
+        Answer the JSON lines requests read from lines, writing each answer with write(line) once it is done
+        """
+
+        lock = threading.Lock()
+
+        def answer(line):
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                result = {"id": None, "error": "Invalid request: {}".format(e)}
+            else:
+                result = self.handle(request) if isinstance(request, dict) else {"id": None, "error": "Invalid request: not an object"}
+            with lock:
+                write(json.dumps(result) + '\n')
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(self.jobs, 1)) as pool:
+            for line in lines:
+                if line.strip():
+                    pool.submit(answer, line)
+
+def serve_stdin(daemon):
+    #Answers keep the original stdout, everything else (progress messages, rcssserver and teams) goes to stderr
+    sys.stdout.flush()
+    out = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    def write(line):
+        out.write(line)
+        out.flush()
+
+    daemon.serve(sys.stdin, write)
+
+def serve_socket(daemon, path):
+    """
+    Serve the daemon on a local Unix socket at path, each connection being a stream of requests
+    """
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            def write(line):
+                self.wfile.write(line.encode())
+                self.wfile.flush()
+
+            daemon.serve((line.decode() for line in self.rfile), write)
+
+    if os.path.exists(path):
+        os.remove(path)
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+    with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Answer ranking and posterior requests sent as JSON lines")
+    parser.add_argument("--socket", type=str, default=None, help="Path of the Unix socket to listen on, stdin and stdout if unset")
+    parser.add_argument("--jobs", type=int, default=4, help="Number of requests of a stream handled simultaneously")
+    parser.add_argument("--metrics", type=str2bool, default=False, help="Record timings and counters, returned by stats requests")
+    args = Dotdict(vars(parser.parse_args()))
+    if args.metrics:
+        metrics.enable()
+    daemon = Daemon(args.jobs)
+    if args.socket:
+        serve_socket(daemon, args.socket)
+    else:
+        serve_stdin(daemon)
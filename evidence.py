@@ -0,0 +1,135 @@
+"""
+Head-to-head evidence shared by the rounds of a tournament.
+
+Two teams often meet again in later rounds. Every game played between two teams is recorded in
+an EvidenceCache keyed by the ordered pair of (name, binary) of the teams, so that a later pairing
+of the same teams does not start again from scratch. What is carried over is set by a policy:
+    none: Nothing, every pairing starts from Beta(2, 2) priors
+    decision: Reuse the earlier decision if the recorded games alone still separate the teams'
+              HDIs at the current confidence mass, otherwise start from scratch
+    evidence: Reuse the decision like "decision", otherwise seed both teams' posteriors with the
+              recorded games, weighted by carry_weight and capped to carry_max games
+The sides of a pair are assumed to be equivalent: games recorded for (A, B) are used, swapped,
+for a later (B, A) pairing. Games are recorded once, by match id, as the backend plays them or the
+match store replays them; the store replays the games of a round only, so carried games are not counted twice.
+"""
+
+import threading
+
+import team
+
+POLICIES = ["none", "decision", "evidence"]
+
+class EvidenceCache():
+    def __init__(self, policy="evidence", carry_weight=1.0, carry_max=None):
+        """
+        EvidenceCache constructor:
+            policy: What is carried over to a later pairing of the same teams (string, see POLICIES)
+            carry_weight: Weight of an earlier game in the seeded posteriors (float 0 <= x <= 1)
+            carry_max: Maximal number of earlier games carried over, None for all (int)
+        """
+        assert policy in POLICIES, "Unknown evidence policy: {}".format(policy)
+        assert (carry_weight >= 0 and carry_weight <= 1), "The carry weight should be a number between 0 and 1"
+        self.policy = policy
+        self.carry_weight = carry_weight
+        self.carry_max = carry_max
+        self.lock = threading.Lock()
+        self.games = {} #[wins of the first team, wins of the second team, games] of each ordered pair
+        self.match_ids = set() #Games already recorded
+
+    def record(self, team_l, team_r, score, match_id=None):
+        """
+        Record a game:
+            team_l, team_r: (name, binary) of the left and right teams (tuple)
+            score: (team_l, team_r) goals, None for a game which failed (tuple)
+            match_id: Identifier of the game, a game already recorded is ignored (string)
+        """
+        if score is None:
+            return
+        with self.lock:
+            if match_id is not None:
+                if match_id in self.match_ids: #Replayed by both the match store and a journal
+                    return
+                self.match_ids.add(match_id)
+            entry = self.games.setdefault((team_l, team_r), [0, 0, 0])
+            entry[0] += int(score[0] > score[1])
+            entry[1] += int(score[0] < score[1])
+            entry[2] += 1
+
+    def lookup(self, team_l, team_r):
+        """
+        Return the games recorded between two teams as (wins of team_l, wins of team_r, games) (tuple)
+        """
+
+        with self.lock:
+            won_l, won_r, games = self.games.get((team_l, team_r), (0, 0, 0))
+            swapped = self.games.get((team_r, team_l), (0, 0, 0))
+
+        return won_l + swapped[1], won_r + swapped[0], games + swapped[2]
+
+    def decision(self, team_l, team_r, confidence_mass):
+        """
+        Return the earlier decision if the recorded games alone still separate the teams:
+        1 if team_l > team_r, -1 if team_l < team_r, None if there is no valid decision (int)
+        """
+
+        if self.policy == "none":
+            return None
+        won_l, won_r, games = self.lookup(team_l, team_r)
+        if games == 0:
+            return None
+        decision = team.compare(team.Team(2 + won_l, 2 + games - won_l, confidence_mass, "", ""),
+                                team.Team(2 + won_r, 2 + games - won_r, confidence_mass, "", ""))
+
+        return decision if decision != 0 else None
+
+    def prior(self, team_l, team_r):
+        """
+        Return the carried over evidence seeding a new pairing as (wins of team_l, wins of team_r, games),
+        None if nothing is carried over (tuple of float)
+        """
+
+        if self.policy != "evidence":
+            return None
+        won_l, won_r, games = self.lookup(team_l, team_r)
+        if games == 0:
+            return None
+        scale = self.carry_weight
+        if self.carry_max is not None and games > self.carry_max:
+            scale *= self.carry_max / games
+
+        return won_l * scale, won_r * scale, games * scale
+
+    def backend(self, team_l, team_r, backend):
+        """
+        Wrap the backend of a pairing so that its games are recorded
+        """
+
+        return EvidenceBackend(self, team_l, team_r, backend)
+
+class EvidenceBackend():
+    def __init__(self, cache, team_l, team_r, backend):
+        """
+        EvidenceBackend constructor:
+            cache: Evidence of the tournament (EvidenceCache)
+            team_l, team_r: (name, binary) of the left and right teams of the pairing (tuple)
+            backend: Backend playing the games (see backends.py)
+        """
+        self.cache = cache
+        self.team_l = team_l
+        self.team_r = team_r
+        self.backend = backend
+
+    def play(self, left_team, right_team, number_games):
+        games = self.backend.play(left_team, right_team, number_games)
+        try:
+            for result in games:
+                if result is not None:
+                    self.cache.record(self.team_l, self.team_r, result[1], result[0])
+                yield result
+        finally:
+            games.close()
+
+    def stored(self, left_team, right_team, result):
+        #Game replayed from a match store (see bayes_ranker.iter_games)
+        self.cache.record(self.team_l, self.team_r, result[1], result[0])
@@ -0,0 +1,351 @@
+"""
+Distributed match workers coordinated over a job queue.
+
+A coordinator hosts a queue of match jobs (team binaries, fast mode, number of games) reachable
+over the network with multiprocessing.managers. Rankings submit their games through QueueBackend
+(--backend queue) and worker processes, on any number of machines, pull the jobs, play them with
+their own local backend (rcssserver or synthetic) and send the scores back.
+
+A worker holds a lease on its job, renewed by heartbeats; when a worker dies its lease expires
+and the job is queued again, up to MAX_RETRIES times. The coordinator keeps per-worker throughput
+statistics.
+
+Usage:
+    python job_queue.py coordinator --queue 0.0.0.0:50000 --authkey secret
+    python job_queue.py worker --queue coordinator-host:50000 --authkey secret [--backend synthetic]
+    python job_queue.py stats --queue coordinator-host:50000 --authkey secret
+"""
+
+import argparse
+import collections
+import itertools
+import socket
+import threading
+import time
+import os
+from multiprocessing.managers import BaseManager
+
+from utils import Dotdict, str2bool
+import backends
+import log_storage
+
+LEASE_TIMEOUT = 60 #Seconds without heartbeat after which a job is given to another worker
+HEARTBEAT_INTERVAL = 10 #Seconds between two heartbeats of a worker playing a job
+MAX_RETRIES = 3 #Number of times a job is queued again after its worker died or failed
+POLL_INTERVAL = 1 #Seconds a worker or a backend waits for a job or a result before checking again
+AUTHKEY_VARIABLE = "BAYESRANKING_AUTHKEY" #Environment variable holding the shared secret when --authkey is not given
+LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+class JobQueue():
+    def __init__(self, lease_timeout=LEASE_TIMEOUT, max_retries=MAX_RETRIES):
+        """
+        JobQueue constructor, lives in the coordinator:
+            lease_timeout: Seconds without heartbeat after which a job is queued again (float)
+            max_retries: Number of times a job is queued again before it is failed (int)
+        """
+        self.lease_timeout = lease_timeout
+        self.max_retries = max_retries
+        self.condition = threading.Condition()
+        self.ids = itertools.count()
+        self.pending = collections.deque() #Job ids waiting for a worker
+        self.jobs = {} #Job of each id
+        self.leases = {} #(worker id, deadline) of each running job
+        self.retries = collections.Counter()
+        self.done = {} #("done", results) or ("failed", error) of each finished job
+        self.workers = {} #Statistics of each worker
+
+    def _worker(self, worker_id):
+        if worker_id not in self.workers:
+            self.workers[worker_id] = {"jobs": 0, "games": 0, "busy": 0.0, "failures": 0, "expired": 0, "last_seen": None}
+        self.workers[worker_id]["last_seen"] = time.time()
+
+        return self.workers[worker_id]
+
+    def _retry(self, job_id, error):
+        #Queue a job again or fail it when it ran out of retries
+        self.leases.pop(job_id, None)
+        self.retries[job_id] += 1
+        if self.retries[job_id] > self.max_retries:
+            self.done[job_id] = ("failed", error)
+            self.condition.notify_all()
+        else:
+            self.pending.appendleft(job_id)
+            self.condition.notify_all()
+
+    def _reap(self):
+        #Queue again the jobs of the workers which stopped sending heartbeats
+        now = time.time()
+        for job_id, (worker_id, deadline) in list(self.leases.items()):
+            if deadline < now:
+                self._worker(worker_id)["expired"] += 1
+                self._retry(job_id, "lease of worker {} expired".format(worker_id))
+
+    def submit(self, job):
+        """
+        Queue a job: dict with the left_team, right_team, fast_mode and count (number of games) keys
+
+        Return the job id (int)
+        """
+        with self.condition:
+            job_id = next(self.ids)
+            self.jobs[job_id] = dict(job)
+            self.pending.append(job_id)
+            self.condition.notify_all()
+
+        return job_id
+
+    def get_job(self, worker_id, wait=POLL_INTERVAL):
+        """
+        Lease the next job to a worker, waiting at most wait seconds for one
+
+        Return the (job id, job) leased, None if there is none (tuple)
+        """
+        with self.condition:
+            self._worker(worker_id)
+            deadline = time.time() + wait
+            while True:
+                self._reap()
+                while self.pending:
+                    job_id = self.pending.popleft()
+                    if job_id in self.jobs and job_id not in self.done: #Not cancelled
+                        self.leases[job_id] = (worker_id, time.time() + self.lease_timeout)
+                        return job_id, self.jobs[job_id]
+                left = deadline - time.time()
+                if left <= 0:
+                    return None
+                self.condition.wait(left)
+
+    def heartbeat(self, worker_id, job_id):
+        """
+        Renew the lease of a running job
+
+        Return False if the job was cancelled or given to another worker (bool)
+        """
+        with self.condition:
+            self._worker(worker_id)
+            if job_id in self.leases and self.leases[job_id][0] == worker_id:
+                self.leases[job_id] = (worker_id, time.time() + self.lease_timeout)
+                return True
+
+            return False
+
+    def complete(self, worker_id, job_id, results, seconds):
+        """
+        Report the results of a job: one (match_id, (team_l, team_r), log) tuple or None per game
+        """
+        with self.condition:
+            stats = self._worker(worker_id)
+            stats["jobs"] += 1
+            stats["games"] += sum(1 for r in results if r is not None)
+            stats["busy"] += seconds
+            if job_id in self.jobs and job_id not in self.done:
+                self.leases.pop(job_id, None)
+                self.done[job_id] = ("done", [tuple(r) if r is not None else None for r in results])
+                self.condition.notify_all()
+
+    def fail(self, worker_id, job_id, error):
+        """
+        Report a job its worker could not play, it is queued again
+        """
+        with self.condition:
+            self._worker(worker_id)["failures"] += 1
+            if job_id in self.leases and job_id not in self.done:
+                self._retry(job_id, error)
+
+    def wait_any(self, job_ids, wait=POLL_INTERVAL):
+        """
+        Wait at most wait seconds until one of the jobs is finished
+
+        Return the (job id, status, results or error) of the finished jobs, which are forgotten (list)
+        """
+        with self.condition:
+            deadline = time.time() + wait
+            while True:
+                self._reap()
+                finished = [job_id for job_id in job_ids if job_id in self.done]
+                left = deadline - time.time()
+                if finished or left <= 0:
+                    break
+                self.condition.wait(left)
+            results = []
+            for job_id in finished:
+                status, value = self.done[job_id]
+                results.append((job_id, status, value))
+                del self.jobs[job_id]
+                del self.done[job_id]
+                self.retries.pop(job_id, None)
+
+            return results
+
+    def cancel(self, job_ids):
+        """
+        Drop jobs which are not needed anymore, running ones are dropped when their worker reports
+        """
+        with self.condition:
+            for job_id in job_ids:
+                self.jobs.pop(job_id, None)
+                self.leases.pop(job_id, None)
+                self.done.pop(job_id, None)
+                self.retries.pop(job_id, None)
+
+    def stats(self):
+        """
+        Return the queue length and the statistics of each worker, with its throughput in games per second (dict)
+        """
+        with self.condition:
+            workers = {}
+            for worker_id, stats in self.workers.items():
+                workers[worker_id] = dict(stats, games_per_second=stats["games"] / stats["busy"] if stats["busy"] > 0 else 0.0)
+
+            return {"pending": len(self.pending), "running": len(self.leases), "workers": workers}
+
+class QueueManager(BaseManager):
+    pass
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+
+    return host, int(port)
+
+def resolve_authkey(authkey=None):
+    """
+    Return the shared secret of the coordinator: authkey, or the AUTHKEY_VARIABLE environment variable (string)
+    """
+
+    authkey = authkey or os.environ.get(AUTHKEY_VARIABLE)
+    if not authkey:
+        raise ValueError("The coordinator needs a shared secret: set --authkey or the {} environment variable".format(AUTHKEY_VARIABLE))
+
+    return authkey
+
+def serve(address, authkey, job_queue=None):
+    """
+    Run a coordinator serving job_queue (a new JobQueue by default) at address "host:port"; blocks.
+    The coordinator unpickles what its clients send, so it only listens beyond the loopback interface with a secret.
+    """
+
+    host, port = parse_address(address)
+    if not authkey and host not in LOOPBACK_HOSTS:
+        raise ValueError("Refusing to serve the job queue on {} without a shared secret".format(host))
+    job_queue = job_queue or JobQueue()
+    QueueManager.register('jobs', callable=lambda: job_queue)
+    manager = QueueManager(address=(host, port), authkey=authkey.encode())
+    manager.get_server().serve_forever()
+
+def connect(address, authkey):
+    """
+    Connect to the coordinator at address "host:port"
+
+    Return a proxy of its JobQueue
+    """
+
+    QueueManager.register('jobs')
+    manager = QueueManager(address=parse_address(address), authkey=authkey.encode())
+    manager.connect()
+
+    return manager.jobs()
+
+class QueueBackend():
+    def __init__(self, address, authkey, fast_mode=True):
+        """
+        QueueBackend constructor, plays the games on the workers of a coordinator:
+            address: Coordinator address "host:port" (string)
+            authkey: Shared secret of the coordinator (string)
+            fast_mode: Run the servers in synchronous (fast) mode (bool)
+        """
+        self.address = address
+        self.authkey = authkey
+        self.fast_mode = fast_mode
+        self.local = threading.local() #One connection per thread
+
+    @property
+    def jobs(self):
+        if not hasattr(self.local, "jobs"):
+            self.local.jobs = connect(self.address, self.authkey)
+
+        return self.local.jobs
+
+    def play(self, left_team, right_team, number_games):
+        #One job per game so that games spread over the workers and can be cancelled one by one
+        job_ids = [self.jobs.submit({"left_team": left_team, "right_team": right_team, "fast_mode": self.fast_mode, "count": 1}) for i in range(number_games)]
+        waiting = set(job_ids)
+        try:
+            while waiting:
+                for job_id, status, value in self.jobs.wait_any(list(waiting)):
+                    waiting.discard(job_id)
+                    if status == "failed":
+                        print("Game failed on every worker: {}".format(value))
+                        yield None
+                        continue
+                    for result in value:
+                        yield result
+        finally:
+            if waiting:
+                self.jobs.cancel(list(waiting))
+
+def work(args):
+    """
+    Worker loop: pull jobs from the coordinator, play them with the backend selected by
+    args.backend and report the results, until args.max_jobs jobs are played (forever if unset)
+    """
+
+    jobs = connect(args.queue, args.authkey)
+    worker_id = args.worker_id or "{}-{}".format(socket.gethostname(), os.getpid())
+    played = 0
+    while not args.max_jobs or played < args.max_jobs:
+        leased = jobs.get_job(worker_id)
+        if leased is None:
+            continue
+        job_id, job = leased
+        job_args = Dotdict(args)
+        job_args.fastm = job["fast_mode"]
+        job_args.stream = ("job", str(job_id)) #Seeded synthetic games differ from one job to the next
+        backend = backends.make_backend(job_args)
+        finished = threading.Event()
+
+        def beat(job_id=job_id):
+            #Heartbeats from a thread with its own connection
+            heart = connect(args.queue, args.authkey)
+            while not finished.wait(HEARTBEAT_INTERVAL):
+                if not heart.heartbeat(worker_id, job_id):
+                    break
+
+        heartbeat = threading.Thread(target=beat, daemon=True)
+        heartbeat.start()
+        start = time.time()
+        try:
+            results = list(backend.play(job["left_team"], job["right_team"], job["count"]))
+        except Exception as e:
+            jobs.fail(worker_id, job_id, repr(e))
+        else:
+            jobs.complete(worker_id, job_id, results, time.time() - start)
+        finally:
+            finished.set()
+        played += 1
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Coordinator and workers of distributed RoboCup Simulation 2D games", parents=[log_storage.arguments()])
+    parser.add_argument("mode", choices=["coordinator", "worker", "stats"], help="Run a coordinator, a worker or print the workers' statistics")
+    parser.add_argument("--queue", type=str, default="127.0.0.1:50000", help="Address host:port of the coordinator")
+    parser.add_argument("--authkey", type=str, default=None, help="Shared secret of the coordinator and its workers (default: the {} environment variable)".format(AUTHKEY_VARIABLE))
+    parser.add_argument("--worker_id", type=str, default=None, help="Name of the worker in the statistics (default: host-pid)")
+    parser.add_argument("--max_jobs", type=int, default=None, help="Number of jobs played before the worker exits")
+    parser.add_argument("--backend", type=str, default="rcssserver", choices=["rcssserver", "synthetic"], help="Backend playing the games of the worker")
+    parser.add_argument("--strengths", type=str, default=None, help="JSON file of the latent strengths of the teams by script path (synthetic backend)")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the synthetic backend")
+    parser.add_argument("--logdir", type=str, default="logs", help="Path to the directory for storing resulting log files")
+    parser.add_argument("--timeout", type=float, default=None, help="Wall-clock limit of a game in seconds")
+    parser.add_argument("--port", type=int, default=None, help="Server port of the worker's games (default: the server default)")
+    parser.add_argument("--async_driver", type=str2bool, default=False, help="Run rcssserver and the teams as managed subprocesses on an asyncio event loop")
+    args = Dotdict(vars(parser.parse_args()))
+    try:
+        args.authkey = resolve_authkey(args.authkey)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.mode == "coordinator":
+        serve(args.queue, args.authkey)
+    elif args.mode == "worker":
+        work(args)
+    else:
+        for worker_id, stats in sorted(connect(args.queue, args.authkey).stats()["workers"].items()):
+            print("%s: %d jobs, %d games, %.2f games/s, %d failures, %d expired leases"%(worker_id, stats["jobs"], stats["games"], stats["games_per_second"], stats["failures"], stats["expired"]))
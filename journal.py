@@ -0,0 +1,109 @@
+"""
+Append-only journal of a tournament run.
+
+Every game played for a pairing and the winner of every finished pairing are appended to a
+JSON lines file as the tournament runs. A restarted run reads the journal back: finished
+pairings are not played again and the games of an unfinished pairing are replayed, in the
+order they were played, before any new game is simulated, so its posteriors are restored
+exactly and no simulation is run twice. With a match store, the store replays the games it
+recorded first: bayes_ranker.iter_games drops the journaled games the store already served.
+
+A pairing is identified by its round, group and left and right team names.
+"""
+
+import json
+import os
+import threading
+
+class Journal():
+    def __init__(self, path):
+        """
+        Journal constructor:
+            path: Path to the journal, created if needed and read back if it exists (string)
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.games = {} #Journaled games of each pairing
+        self.results = {} #Winner of each finished pairing (None for a draw)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError: #Line cut by a crash
+                        continue
+                    key = tuple(entry["pairing"])
+                    if entry["event"] == "game":
+                        score = tuple(entry["score"]) if entry["score"] is not None else None
+                        self.games.setdefault(key, []).append((entry["match_id"], score, entry["log"]))
+                    elif entry["event"] == "result":
+                        self.results[key] = entry["winner"]
+        self.file = open(path, 'a')
+
+    def _append(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def record_game(self, key, result):
+        """
+        Append a game of a pairing:
+            key: (round, group, left team name, right team name) (tuple)
+            result: (match_id, score, log) played game, None for a game which failed (tuple)
+        """
+        match_id, score, log = result if result is not None else (None, None, None)
+        self._append({"event": "game", "pairing": list(key), "match_id": match_id, "score": score, "log": log})
+
+    def record_result(self, key, winner):
+        """
+        Append the winner (name or None) of a finished pairing
+        """
+        with self.lock:
+            self.results[key] = winner
+        self._append({"event": "result", "pairing": list(key), "winner": winner})
+
+    def backend(self, key, backend):
+        """
+        Wrap the backend of a pairing so that its journaled games are replayed first and its new games journaled
+        """
+
+        return JournalBackend(self, key, backend)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class JournalBackend():
+    def __init__(self, journal, key, backend):
+        """
+        JournalBackend constructor:
+            journal: Journal of the tournament (Journal)
+            key: Pairing played through this backend (tuple)
+            backend: Backend playing the games which are not journaled (see backends.py)
+        """
+        self.journal = journal
+        self.key = key
+        self.backend = backend
+        self.replay = list(journal.games.get(key, []))
+        self.cursor = 0
+        self.skipped = False
+
+    def play(self, left_team, right_team, number_games):
+        while number_games > 0 and self.cursor < len(self.replay):
+            result = self.replay[self.cursor]
+            self.cursor += 1
+            number_games -= 1
+            yield result
+        if number_games > 0 and not self.skipped:
+            #Seeded backends (backends.SyntheticBackend) go on after the replayed games instead of drawing them again
+            if self.replay and hasattr(self.backend, "skip"):
+                self.backend.skip(left_team, right_team, len(self.replay))
+            self.skipped = True
+        games = self.backend.play(left_team, right_team, number_games)
+        try:
+            for result in games:
+                self.journal.record_game(self.key, result)
+                yield result
+        finally:
+            games.close()
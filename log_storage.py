@@ -0,0 +1,166 @@
+"""
+Storage of the game logs written by rcssserver.
+
+Every game writes its .rcg log in its own directory under the log directory. A LogStorage takes
+the log once the game is over and moves it into a sharded layout
+    <log directory>/<shard>/<game directory name>-<log name>[.gz|.zst]
+(shard: first characters of a hash of the name, so that no directory grows too large; the game
+directory name keeps apart the logs of simultaneous games with the same score), compressed
+with gzip or zstd if asked, then removes the game's directory. A retention limit on the number of
+logs and/or their total size removes the oldest logs. In score-only mode the logs are removed as
+soon as their score is known: the score is in the log name (see robocup_utils.extract_results).
+Without any storage option the logs are moved, uncompressed, into the log directory itself
+(see backends.keep_log).
+
+open_log opens a stored log whatever its compression, for replay tooling.
+
+zstd compression needs the zstandard package.
+"""
+
+import argparse
+import collections
+import gzip
+import hashlib
+import os
+import shutil
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from utils import str2bool
+
+SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"} #File suffix of each compression
+SHARD_WIDTH = 2 #Hexadecimal characters of the shard names (256 shards)
+
+def open_log(path):
+    """
+    Open a stored log for binary reading, decompressing it according to its suffix
+    """
+
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rb')
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError("Reading zstd compressed logs needs the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+
+    return open(path, 'rb')
+
+class LogStorage():
+    def __init__(self, root, compression=None, max_logs=None, max_bytes=None, score_only=False):
+        """
+        LogStorage constructor:
+            root: Directory of the stored logs (string)
+            compression: None, "gzip" or "zstd" (string)
+            max_logs: Maximal number of stored logs, None for no limit (int)
+            max_bytes: Maximal total size of the stored logs in bytes, None for no limit (int)
+            score_only: Do not keep the logs, only their score (bool)
+        """
+        assert compression in SUFFIXES, "Unknown log compression: {}".format(compression)
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("zstd log compression needs the zstandard package")
+        self.root = root
+        self.compression = compression
+        self.max_logs = max_logs
+        self.max_bytes = max_bytes
+        self.score_only = score_only
+        self.lock = threading.Lock()
+        self.logs = collections.deque() #(path, size) of the stored logs, oldest first
+        self.size = 0
+        #Logs stored by earlier runs count in the retention limits
+        stored = []
+        if os.path.isdir(root):
+            for shard in os.listdir(root):
+                directory = os.path.join(root, shard)
+                if len(shard) == SHARD_WIDTH and os.path.isdir(directory):
+                    for name in os.listdir(directory):
+                        path = os.path.join(directory, name)
+                        stat = os.stat(path)
+                        stored.append((stat.st_mtime, path, stat.st_size))
+        for mtime, path, size in sorted(stored):
+            self.logs.append((path, size))
+            self.size += size
+
+    def shard(self, name):
+        return hashlib.sha1(name.encode()).hexdigest()[:SHARD_WIDTH]
+
+    def store(self, log):
+        """
+        Move a game log written by rcssserver into the storage and remove its game directory
+
+        Return the path of the stored log, None in score-only mode (string)
+        """
+
+        directory = os.path.dirname(log)
+        if self.score_only:
+            shutil.rmtree(directory, ignore_errors=True)
+            return None
+        name = os.path.basename(directory) + "-" + os.path.basename(log)
+        target_dir = os.path.join(self.root, self.shard(name))
+        os.makedirs(target_dir, exist_ok=True)
+        target = os.path.join(target_dir, name + SUFFIXES[self.compression])
+        if self.compression is None:
+            shutil.move(log, target)
+        else:
+            with open(log, 'rb') as src:
+                if self.compression == "gzip":
+                    with gzip.open(target, 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                else:
+                    with open(target, 'wb') as dst:
+                        zstandard.ZstdCompressor().copy_stream(src, dst)
+        shutil.rmtree(directory, ignore_errors=True)
+        size = os.path.getsize(target)
+        with self.lock:
+            self.logs.append((target, size))
+            self.size += size
+            self.enforce()
+
+        return target
+
+    def enforce(self):
+        #Remove the oldest logs until the retention limits hold
+        while self.logs and ((self.max_logs is not None and len(self.logs) > self.max_logs)
+                             or (self.max_bytes is not None and self.size > self.max_bytes)):
+            path, size = self.logs.popleft()
+            self.size -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def arguments():
+    """
+    Return the parser of the log storage options, to be given as a parent to the command line
+    parsers playing games (argparse.ArgumentParser)
+    """
+
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--log_compression", type=str, default="none", choices=["none", "gzip", "zstd"], help="Compression of the stored game logs")
+    parser.add_argument("--log_max_count", type=int, default=None, help="Number of game logs kept, the oldest are removed")
+    parser.add_argument("--log_max_bytes", type=int, default=None, help="Total size in bytes of the game logs kept, the oldest are removed")
+    parser.add_argument("--score_only", type=str2bool, default=False, help="Remove the game logs once their score is known")
+
+    return parser
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+def from_args(args):
+    """
+    Return the LogStorage set by args (log_compression, log_max_count, log_max_bytes, score_only) under
+    args.logdir, shared by the backends of the process; None if none is set (the logs are kept in args.logdir)
+    """
+
+    compression = args.log_compression if args.log_compression != "none" else None
+    if compression is None and args.log_max_count is None and args.log_max_bytes is None and not args.score_only:
+        return None
+    key = (os.path.abspath(args.logdir), compression, args.log_max_count, args.log_max_bytes, bool(args.score_only))
+    with _storages_lock:
+        if key not in _storages:
+            _storages[key] = LogStorage(*key)
+
+        return _storages[key]
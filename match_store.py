@@ -0,0 +1,96 @@
+"""
+Persistent store of game results.
+
+Every game played for a pairing is recorded in an indexed SQLite table keyed by the
+stage of the tournament, the team names, the team binaries and a match id (the path of the
+game's private log directory). Stored games are replayed in the order they were played, so that
+re-running a pairing reuses the recorded results before simulating any new game.
+A stage (round and group of a tournament) only replays its own games: a rematch in a later round
+plays new games, the earlier ones are carried over by the evidence cache (see evidence.py).
+"""
+
+import os
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    left_name TEXT NOT NULL,
+    right_name TEXT NOT NULL,
+    left_bin TEXT NOT NULL,
+    right_bin TEXT NOT NULL,
+    match_id TEXT NOT NULL UNIQUE,
+    score_l INTEGER NOT NULL,
+    score_r INTEGER NOT NULL,
+    log TEXT,
+    stage TEXT NOT NULL DEFAULT ''
+);
+"""
+
+INDEX = "CREATE INDEX IF NOT EXISTS matches_stage ON matches (stage, left_name, right_name, left_bin, right_bin, id)"
+
+class MatchStore():
+    def __init__(self, path, stage=""):
+        """
+        MatchStore constructor:
+            path: Path to the SQLite database, created if needed (string)
+            stage: Stage of the tournament the games are recorded and replayed for, "" outside a tournament (string)
+        """
+        self.path = path
+        self.stage = stage
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+            columns = [c[1] for c in self.connection.execute("PRAGMA table_info(matches)")]
+            if "stage" not in columns: #Database of an earlier version, its games belong to no stage
+                self.connection.execute("ALTER TABLE matches ADD COLUMN stage TEXT NOT NULL DEFAULT ''")
+            self.connection.execute(INDEX)
+
+    def record(self, left_name, right_name, left_bin, right_bin, match_id, score, log=None):
+        """
+        Store the result of a game:
+            left_name, right_name: Team names (string)
+            left_bin, right_bin: Path to the team's script (string)
+            match_id: Unique identifier of the game (string)
+            score: Goals of the left and right teams (tuple of int)
+            log: Path to the game log (string)
+        """
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO matches (stage, left_name, right_name, left_bin, right_bin, match_id, score_l, score_r, log) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (self.stage, left_name, right_name, left_bin, right_bin, match_id, score[0], score[1], log))
+
+    def results(self, left_name, right_name, left_bin, right_bin, offset=0, limit=-1):
+        """
+        Fetch the stored scores of a pairing in the stage in playing order:
+            offset: Number of games to skip (int)
+            limit: Maximal number of games to return, -1 for all (int)
+
+        Return the (match_id, (score_l, score_r), log) results, as played by a backend (list of tuples)
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT match_id, score_l, score_r, log FROM matches WHERE stage = ? AND left_name = ? AND right_name = ? AND left_bin = ? AND right_bin = ? ORDER BY id LIMIT ? OFFSET ?",
+                                           (self.stage, left_name, right_name, left_bin, right_bin, limit, offset)).fetchall()
+
+        return [(r[0], (r[1], r[2]), r[3]) for r in rows]
+
+    def known(self, match_id):
+        """
+        Return True if a game with this match id is stored (bool)
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM matches WHERE match_id = ?", (match_id,)).fetchone()
+
+        return row is not None
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def match_id(log):
+    """
+    Identifier of a game: the absolute path of its private log directory
+    """
+
+    return os.path.abspath(os.path.dirname(log))
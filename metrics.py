@@ -0,0 +1,183 @@
+"""
+Timers and counters of the ranking pipeline.
+
+Stages (simulation, log discovery, result parsing, HDI computation, rankings, tournaments) are
+timed with
+    with metrics.timer("stage"):
+        ...
+and events counted with metrics.count(name) or summarized with metrics.observe(name, value).
+Nothing is recorded until enable() is called: timer() then returns a shared no-op context
+manager, so the instrumentation costs a function call and a flag check on the hot paths.
+
+The HDI calls count the scalar calls (hits and misses of hdi.cache_info() since enable()) and the
+posteriors of the vectorized computations (see team.update_teams). The metrics are exported as JSON
+or in the Prometheus text exposition format.
+"""
+
+import contextlib
+import json
+import threading
+import time
+
+import hdi
+
+PREFIX = "bayesranking" #Prefix of the exported Prometheus metric names
+
+ENABLED = False
+_NULL = contextlib.nullcontext()
+_lock = threading.Lock()
+_started = None
+_counters = {}
+_stages = {} #Name: [count, total, min, max] of the timed stages, in seconds
+_observations = {} #Name: [count, total, min, max] of the observed values
+_hdi_baseline = None #hdi.cache_info() at reset, the cache outlives the metrics
+
+def enable():
+    """
+    Start recording, from zeroed metrics
+    """
+
+    global ENABLED
+    reset()
+    ENABLED = True
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+def reset():
+    global _started, _hdi_baseline
+    with _lock:
+        _started = time.perf_counter()
+        _hdi_baseline = hdi.cache_info()
+        _counters.clear()
+        _stages.clear()
+        _observations.clear()
+
+def _add(summaries, name, value):
+    summary = summaries.get(name)
+    if summary is None:
+        summaries[name] = [1, value, value, value]
+    else:
+        summary[0] += 1
+        summary[1] += value
+        summary[2] = min(summary[2], value)
+        summary[3] = max(summary[3], value)
+
+def count(name, value=1):
+    """
+    Add value to the counter name
+    """
+
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def observe(name, value):
+    """
+    Add value to the count, sum, min and max of the observations name
+    """
+
+    if not ENABLED:
+        return
+    with _lock:
+        _add(_observations, name, value)
+
+class _Timer():
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            _add(_stages, self.name, elapsed)
+
+        return False
+
+def timer(name):
+    """
+    Return a context manager adding its wall time to the stage name (a no-op when disabled)
+    """
+
+    if not ENABLED:
+        return _NULL
+
+    return _Timer(name)
+
+def _summary(summary):
+    n, total, low, high = summary
+
+    return {"count": n, "total": total, "mean": total / n, "min": low, "max": high}
+
+def snapshot():
+    """
+    Return the current metrics (dict):
+        elapsed: Seconds since enable()
+        counters, stages (seconds), observations: Recorded metrics
+        games_per_second: Games played per second of elapsed time
+        hdi: HDI calls (scalar and vectorized), cache hits and misses since enable() (see hdi.cache_info)
+    """
+
+    info = hdi.cache_info()
+    with _lock:
+        elapsed = time.perf_counter() - _started if _started is not None else 0.0
+        hits = info.hits - (_hdi_baseline.hits if _hdi_baseline is not None else 0)
+        misses = info.misses - (_hdi_baseline.misses if _hdi_baseline is not None else 0)
+        report = {
+            "elapsed": elapsed,
+            "counters": dict(_counters),
+            "stages": {name: _summary(s) for name, s in _stages.items()},
+            "observations": {name: _summary(s) for name, s in _observations.items()},
+        }
+    report["games_per_second"] = report["counters"].get("games", 0) / elapsed if elapsed > 0 else 0.0
+    batch = report["counters"].get("hdi_batch_posteriors", 0)
+    report["hdi"] = {"calls": hits + misses + batch, "batch_calls": batch, "cache_hits": hits, "cache_misses": misses, "cache_size": info.currsize}
+
+    return report
+
+def to_json(report=None):
+    return json.dumps(report or snapshot(), indent=2, sort_keys=True)
+
+def to_prometheus(report=None):
+    """
+    Return the metrics in the Prometheus text exposition format (string)
+    """
+
+    report = report or snapshot()
+    lines = []
+
+    def metric(name, kind, samples):
+        lines.append("# TYPE {}_{} {}".format(PREFIX, name, kind))
+        for suffix, labels, value in samples:
+            label = "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels) + "}" if labels else ""
+            lines.append("{}_{}{}{} {}".format(PREFIX, name, suffix, label, repr(float(value))))
+
+    for name, value in sorted(report["counters"].items()):
+        metric(name + "_total", "counter", [("", (), value)])
+    if report["stages"]:
+        samples = []
+        for name, s in sorted(report["stages"].items()):
+            samples += [("_sum", (("stage", name),), s["total"]), ("_count", (("stage", name),), s["count"])]
+        metric("stage_seconds", "summary", samples)
+    for name, s in sorted(report["observations"].items()):
+        metric(name, "summary", [("_sum", (), s["total"]), ("_count", (), s["count"])])
+    metric("hdi_calls_total", "counter", [("", (), report["hdi"]["calls"])])
+    metric("hdi_cache_hits_total", "counter", [("", (), report["hdi"]["cache_hits"])])
+    metric("games_per_second", "gauge", [("", (), report["games_per_second"])])
+    metric("elapsed_seconds", "gauge", [("", (), report["elapsed"])])
+
+    return "\n".join(lines) + "\n"
+
+def write(path):
+    """
+    Write the metrics to path, in the Prometheus text format if it ends with .prom, as JSON otherwise
+    """
+
+    with open(path, 'w') as f:
+        f.write(to_prometheus() if path.endswith(".prom") else to_json())
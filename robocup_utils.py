@@ -1,39 +1,376 @@
 import time
 import os
+import re
+import shlex
+import asyncio
+import signal
+import subprocess
+import queue
+import shutil
+import threading
+import tempfile
+import concurrent.futures
 
-def launch_simulation(l_team, r_team, log_dir, fast_m = False):
+import metrics
+
+DEFAULT_PORT = 6000 #Default player port of rcssserver
+PORT_STRIDE = 3 #Ports used by one server: player port, coach port and online coach port
+TEAM_PORT_OPTION = "-p" #Option of the teams' start scripts setting the server port
+SERVER_READY = "Hit CTRL-C to exit" #Line printed by rcssserver once it accepts clients
+SERVER_SCORE = re.compile(r"Score:\s*(\d+)\s*-\s*(\d+)") #Score line printed by rcssserver, the last one is the final score
+SERVER_STARTUP_DELAY = 5 #Seconds to wait for SERVER_READY before starting the teams anyway
+TEAM_EXIT_DELAY = 5 #Seconds left to the teams to exit after the end of a game
+POLL_INTERVAL = 0.1 #Seconds between two checks of the cancellation of a game
+
+def server_command(log_dir, fast_m = False, port = None, l_team = None, r_team = None):
     """
-    Launch n_sim simulations opposing l_team and r_team distributed over n_proc processes.
-    Call launch_match.
+    Build the rcssserver command line (list of string):
+        l_team, r_team: Start commands of the teams launched by the server, None to launch them separately (string)
     """
 
     if fast_m == True:
         synch_mode = "true"
     else:
         synch_mode = "false"
-    command = ' '.join(["rcssserver",
-                        "server::auto_mode=1",
-                        "server::synch_mode={}".format(synch_mode),
-                        "server::team_l_start={}".format(l_team),
-                        "server::team_r_start={}".format(r_team),
-                        "server::kick_off_wait=50",
-                        "server::half_time=300",
-                        "server::nr_normal_halfs=1",
-                        "server::nr_extra_halfs=0",
-                        "server::penalty_shoot_outs=0",
-                        "server::game_logging=1",
-                        "server::text_logging=0",
-                        "server::log_date_format=%Y%m%d%H%M%S-",
-                        "server::game_log_dir={}".format(log_dir),
-                        "server::text_log_dir={}".format(log_dir)])
-    os.system(command)
+    command = ["rcssserver",
+               "server::auto_mode=1",
+               "server::synch_mode={}".format(synch_mode)]
+    if l_team is not None:
+        command.append("server::team_l_start={}".format(l_team))
+    if r_team is not None:
+        command.append("server::team_r_start={}".format(r_team))
+    command += ["server::kick_off_wait=50",
+                "server::half_time=300",
+                "server::nr_normal_halfs=1",
+                "server::nr_extra_halfs=0",
+                "server::penalty_shoot_outs=0",
+                "server::game_logging=1",
+                "server::text_logging=0",
+                "server::log_date_format=%Y%m%d%H%M%S-",
+                "server::game_log_dir={}".format(log_dir),
+                "server::text_log_dir={}".format(log_dir)]
+    if port is not None:
+        command += ["server::port={}".format(port),
+                    "server::coach_port={}".format(port + 1),
+                    "server::olcoach_port={}".format(port + 2)]
+
+    return command
+
+def team_command(team, port = None):
+    """
+    Start command of a team (string), pointing it to the server port if one is given
+    """
+
+    if port is None:
+        return team
+
+    return ' '.join([team, TEAM_PORT_OPTION, str(port)])
+
+def game_log(log_dir):
+    """
+    Return the path of the game log written in a game's private log_dir, None if there is none (string)
+    """
+
+    #log_dir is private to the game: the only game log in it is the one its server wrote
+    with metrics.timer("log_discovery"):
+        logs = [f for f in os.listdir(log_dir) if f.endswith('.rcg')]
+    if not logs:
+        return None
+
+    return os.path.join(log_dir, logs[0])
+
+def launch_simulation(l_team, r_team, log_dir, fast_m = False, port = None, timeout = None, cancel = None):
+    """
+    Launch a simulation opposing l_team and r_team:
+        l_team, r_team: Path to the team's script (string)
+        log_dir: Directory receiving the game logs (string)
+        fast_m: Run the server in synchronous (fast) mode (bool)
+        port: Player port of the server, the coach ports follow it; None for the server default (int)
+        timeout: Wall-clock limit of the game in seconds, None for no limit (float)
+        cancel: Event aborting the game when set (threading.Event)
+    The server and the teams it starts are killed when the timeout expires and
+    subprocess.TimeoutExpired is raised.
+    log_dir should be private to the game (see launch_simulations).
+
+    Return the path of the game log written by the server, None if there is none or
+    if the game was cancelled (string)
+    """
+
+    command = server_command(log_dir, fast_m, port, team_command(l_team, port), team_command(r_team, port))
+    with metrics.timer("simulation"):
+        #The server gets its own process group so that the teams it spawns are killed with it
+        process = subprocess.Popen(command, start_new_session=True)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    os.killpg(process.pid, signal.SIGKILL)
+                    process.wait()
+                    return None
+                step = POLL_INTERVAL if cancel is not None else None
+                if deadline is not None:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        raise subprocess.TimeoutExpired(command, timeout)
+                    step = left if step is None else min(step, left)
+                try:
+                    process.wait(timeout=step)
+                    break
+                except subprocess.TimeoutExpired:
+                    continue
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            raise
+
+    return game_log(log_dir)
+
+async def _pump(stream, source, on_output):
+    #Forward every output line of a process, draining the pipe so that the process never blocks on it
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        if on_output is not None:
+            on_output(source, line.decode(errors='replace').rstrip('\n'))
+
+async def _start(command, source, on_output):
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, start_new_session=True)
+    pump = asyncio.ensure_future(_pump(process.stdout, source, on_output))
+
+    return process, pump
+
+def _kill(process):
+    #Kill the process group of a managed process (the process and its children)
+    if process.returncode is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+async def run_game(l_team, r_team, log_dir, fast_m = False, port = None, timeout = None, on_output = None):
+    """
+    Play a game with rcssserver and both teams started as managed subprocesses (no shell):
+        l_team, r_team: Start command of the teams, split like a shell would (string)
+        log_dir: Directory private to the game receiving its log (string)
+        port: Player port of the server and the teams, None for the server default (int)
+        timeout: Wall-clock limit of the game in seconds, None for no limit (float)
+        on_output: Callable on_output(source, line) receiving the output lines of the
+                   server ("server") and of the teams ("left", "right")
+    The teams are started once the server announces it is ready (SERVER_READY, or after
+    SERVER_STARTUP_DELAY seconds). When the timeout expires every process of the game is killed
+    and asyncio.TimeoutError is raised; the teams are killed TEAM_EXIT_DELAY seconds after
+    the end of the game if they did not exit by themselves.
+    The final score is read from the server output (SERVER_SCORE), or from the name of the
+    game log if the server did not print it.
+
+    Return the path of the game log and the final (team_l, team_r) score (tuple)
+    """
+
+    ready = asyncio.Event()
+    score = None
+
+    def watch_server(source, line):
+        nonlocal score
+        if SERVER_READY in line:
+            ready.set()
+        found = SERVER_SCORE.search(line)
+        if found is not None:
+            score = (int(found.group(1)), int(found.group(2)))
+        if on_output is not None:
+            on_output(source, line)
+
+    server, server_pump = await _start(server_command(log_dir, fast_m, port), "server", watch_server)
+    processes = [server]
+    pumps = [server_pump]
+    try:
+        async def play():
+            try:
+                await asyncio.wait_for(ready.wait(), SERVER_STARTUP_DELAY)
+            except asyncio.TimeoutError:
+                pass
+            for source, team in (("left", l_team), ("right", r_team)):
+                process, pump = await _start(shlex.split(team_command(team, port)), source, on_output)
+                processes.append(process)
+                pumps.append(pump)
+            await server.wait()
+
+        with metrics.timer("simulation"):
+            await asyncio.wait_for(play(), timeout)
+            #The game is over: give the teams some time to exit by themselves
+            try:
+                await asyncio.wait_for(asyncio.gather(*(p.wait() for p in processes[1:])), TEAM_EXIT_DELAY)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for process in processes:
+            _kill(process)
+        await asyncio.gather(*(p.wait() for p in processes))
+        await asyncio.gather(*pumps)
+    log = game_log(log_dir)
+    if log is None:
+        raise RuntimeError("rcssserver exited with code {} without writing a game log in {}".format(server.returncode, log_dir))
+
+    if score is None:
+        score = extract_results(log)
+
+    return log, score
+
+def _ports(workers, base_port):
+    #Player port of each concurrent server
+    if workers == 1 and base_port is None: #Single server on the default port
+        return [None]
+
+    return [(base_port or DEFAULT_PORT) + k * PORT_STRIDE for k in range(workers)]
+
+def _async_player(l_team, r_team, log_dir, fast_m, workers, timeout, base_port, on_output):
+    #Coroutine function playing the i-th game of a batch on one of the free port ranges
+    ports = asyncio.Queue()
+    for port in _ports(workers, base_port):
+        ports.put_nowait(port)
+
+    async def play(i):
+        port = await ports.get()
+        os.makedirs(log_dir, exist_ok=True)
+        match_dir = tempfile.mkdtemp(prefix="match_{}_".format(i), dir=log_dir)
+        result = None
+        try:
+            result = await run_game(l_team, r_team, match_dir, fast_m, port, timeout, on_output)
+        except asyncio.TimeoutError:
+            print("Game {} timed out after {} seconds".format(i, timeout))
+        except (OSError, RuntimeError) as e:
+            print("Game {} failed: {}".format(i, e))
+        finally:
+            ports.put_nowait(port)
+            if result is None: #Timed out, failed or cancelled: nothing to keep
+                shutil.rmtree(match_dir, ignore_errors=True)
+
+        return result
+
+    return play
+
+async def run_games(l_team, r_team, n_sim, log_dir, fast_m = False, workers = 1, timeout = None, base_port = None, on_output = None):
+    """
+    Play n_sim games on a single event loop, at most workers at the same time, each with its own
+    port range and private log directory (see launch_simulations and run_game)
+
+    Return the (log, (team_l, team_r)) log path and score of every game, None for games
+    which timed out or failed (list)
+    """
+
+    play = _async_player(l_team, r_team, log_dir, fast_m, max(workers or 1, 1), timeout, base_port, on_output)
+
+    return list(await asyncio.gather(*(play(i) for i in range(n_sim))))
+
+def iter_simulations(l_team, r_team, n_sim, log_dir, fast_m = False, workers = 1, timeout = None, base_port = None, use_async = False):
+    """
+    Launch n_sim simulations like launch_simulations but yield the (i, result) index and result
+    of each game as soon as it is finished. Closing the generator cancels the remaining games:
+    games not started yet are dropped and running servers and teams are killed.
+    The private directories of the games which timed out, failed, were cancelled or were not
+    yielded before the generator was closed are removed.
+    """
+
+    workers = max(workers or 1, 1)
+    if use_async:
+        loop = asyncio.new_event_loop()
+        play = _async_player(l_team, r_team, log_dir, fast_m, workers, timeout, base_port, None)
+        tasks = {loop.create_task(play(i)): i for i in range(n_sim)}
+        pending = set(tasks)
+        yielded = set()
+        try:
+            while pending:
+                done, pending = loop.run_until_complete(asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+                for task in done:
+                    yielded.add(task)
+                    yield tasks[task], task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.close()
+            for task in tasks:
+                if task not in yielded and not task.cancelled() and task.exception() is None:
+                    _discard(task.result())
+        return
+
+    cancel = threading.Event()
+    ports = queue.Queue()
+    for port in _ports(workers, base_port):
+        ports.put(port)
+
+    def play(i):
+        if cancel.is_set():
+            return None
+        os.makedirs(log_dir, exist_ok=True)
+        match_dir = tempfile.mkdtemp(prefix="match_{}_".format(i), dir=log_dir)
+        port = ports.get()
+        log = None
+        try:
+            log = launch_simulation(l_team, r_team, match_dir, fast_m, port, timeout, cancel)
+        except subprocess.TimeoutExpired:
+            print("Game {} timed out after {} seconds".format(i, timeout))
+        finally:
+            ports.put(port)
+            if log is None: #Timed out, failed or cancelled: nothing to keep
+                shutil.rmtree(match_dir, ignore_errors=True)
+        if log is None:
+            return None
+
+        return log, extract_results(log)
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    futures = {pool.submit(play, i): i for i in range(n_sim)}
+    yielded = set()
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            yielded.add(future)
+            yield futures[future], future.result()
+    finally:
+        cancel.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+        for future in futures:
+            if future not in yielded and not future.cancelled() and future.exception() is None:
+                _discard(future.result())
+
+def _discard(result):
+    #Remove the private directory of a finished game whose result is not used
+    if result is not None:
+        shutil.rmtree(os.path.dirname(result[0]), ignore_errors=True)
+
+def launch_simulations(l_team, r_team, n_sim, log_dir, fast_m = False, workers = 1, timeout = None, base_port = None, use_async = False):
+    """
+    Launch n_sim simulations opposing l_team and r_team distributed over a pool of workers.
+    Each concurrent server gets its own port range (base_port + k * PORT_STRIDE, base_port
+    defaulting to DEFAULT_PORT; a single worker without base_port uses the server default) and each
+    game its own log directory (log_dir/match_<i>_<random>) so that simultaneous games never collide.
+        timeout: Wall-clock limit of each game in seconds (float)
+        use_async: Play the games with the asyncio driver (run_games) instead of a thread pool (bool)
+
+    Return the (log, (team_l, team_r)) log path and score of every game, None for games
+    which timed out or left no log (list)
+    """
+
+    results = [None] * n_sim
+    for i, result in iter_simulations(l_team, r_team, n_sim, log_dir, fast_m, workers, timeout, base_port, use_async):
+        results[i] = result
+
+    return results
 
 def extract_results(log):
     """
+    Return the final (team_l, team_r) score of a game from the name of its log, compressed
+    (.rcg.gz, .rcg.zst, see log_storage.py) or not (tuple)
     """
 
-    score = log.split("-vs-")
-    team_l = int(score[0].split('_')[-1])
-    team_r = int(score[1][:-4].split('_')[-1])
+    with metrics.timer("result_parsing"):
+        name = os.path.basename(log)
+        for suffix in (".gz", ".zst"):
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+        score = name.split("-vs-")
+        team_l = int(score[0].split('_')[-1])
+        team_r = int(score[1][:-4].split('_')[-1])
 
     return (team_l, team_r)
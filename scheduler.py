@@ -0,0 +1,147 @@
+"""
+Concurrent, dependency-aware scheduling of a tournament.
+
+A group of a round references the rankings of earlier groups ("round_group_rank").
+A group is started as soon as every group it references is finished, and the pairwise
+rankings of all started groups are run concurrently on a pool of workers, so a tournament
+lasts about as long as its critical path instead of the sum of all its games.
+"""
+
+import concurrent.futures
+import queue
+from operator import itemgetter
+
+def parse_reference(reference):
+    """
+    Split a "round_group_rank" reference:
+
+    Return the round (string), the group (string) and the rank starting at 1 (int)
+    """
+
+    split = reference.split('_')
+
+    return split[0], split[1], int(split[2])
+
+def group_dependencies(targs, rounds):
+    """
+    Build the dependency graph of the tournament's groups:
+        targs: Tournament settings (dict)
+        rounds: Round names in playing order, the first one lists team names (list of string)
+
+    Return the groups each (round, group) depends on (dict of sets)
+    """
+
+    dependencies = {(rounds[0], group): set() for group in targs[rounds[0]]}
+    for r in rounds[1:]:
+        for group in targs[r]:
+            dependencies[(r, group)] = set(parse_reference(t)[:2] for t in targs[r][group])
+
+    return dependencies
+
+def ranking(group_scores):
+    """
+    Return the teams of a group sorted by decreasing score (list of (name, score))
+    """
+
+    return sorted(group_scores.items(), key=itemgetter(1), reverse=True)
+
+def run(targs, rounds, rank_pair, jobs=1, on_group_done=None, rank_group=None):
+    """
+    Play a tournament:
+        targs: Tournament settings (dict)
+        rounds: Round names in playing order (list of string)
+        rank_pair: Callable rank_pair(round, group, team_l, team_r, slot) returning the winner's name or None.
+                   slot (0 <= slot < jobs) is unique among the pairs running at the same time
+        jobs: Number of pairwise rankings run simultaneously (int)
+        on_group_done: Callable on_group_done(round, group, scores) called when a group is finished
+        rank_group: Callable rank_group(round, group, teams, slot) ranking every pair of a group at once and
+                    returning the (team_l, team_r, winner's name or None) of each pair; replaces rank_pair if given
+
+    Return the total points of each team (dict) and the scores of each group of each round (dict)
+    """
+
+    teams = {t:0 for t in targs['teams']}
+    tournament_dict = {r:{} for r in rounds}
+    dependencies = group_dependencies(targs, rounds)
+    waiting = set(dependencies)
+    remaining = {} #Number of unfinished pairs of each started group
+    slots = queue.Queue()
+    for k in range(max(jobs, 1)):
+        slots.put(k)
+
+    def play(r, group, team_l, team_r):
+        slot = slots.get()
+        try:
+            return [(team_l, team_r, rank_pair(r, group, team_l, team_r, slot))]
+        finally:
+            slots.put(slot)
+
+    def play_group(r, group, teams_group):
+        slot = slots.get()
+        try:
+            return rank_group(r, group, teams_group, slot)
+        finally:
+            slots.put(slot)
+
+    def finish(node):
+        r, group = node
+        if on_group_done is not None:
+            on_group_done(r, group, tournament_dict[r][group])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        running = {}
+        while waiting or running:
+            #Start every group whose referenced groups are finished
+            started = True
+            while started:
+                started = False
+                finished = set(dependencies) - waiting - set(remaining)
+                for node in sorted((n for n in waiting if dependencies[n] <= finished), key=lambda n: (rounds.index(n[0]), n[1])):
+                    waiting.remove(node)
+                    r, group = node
+                    if r == rounds[0]:
+                        tmp = targs[r][group]
+                    else: #Fetch teams from the referenced rankings
+                        tmp = []
+                        for t in targs[r][group]:
+                            ref_round, ref_group, rank = parse_reference(t)
+                            tmp.append(ranking(tournament_dict[ref_round][ref_group])[rank - 1][0])
+                    tournament_dict[r][group] = {t:0 for t in tmp}
+                    teams_group = list(tournament_dict[r][group].keys())
+                    l = len(teams_group)
+                    remaining[node] = l * (l - 1) // 2
+                    if rank_group is not None and remaining[node] > 0: #A single job for the whole group
+                        remaining[node] = 1
+                        running[pool.submit(play_group, r, group, teams_group)] = node
+                    else:
+                        for i in range(l):
+                            for j in range(i + 1, l):
+                                running[pool.submit(play, r, group, teams_group[i], teams_group[j])] = node
+                    if remaining[node] == 0: #Nothing to play, the groups depending on it may start
+                        del remaining[node]
+                        finish(node)
+                        started = True
+            if not running:
+                if waiting: #Every remaining group references a group which does not exist
+                    raise ValueError("Unresolvable group references: {}".format(sorted(waiting)))
+                break
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                r, group = node
+                for team_l, team_r, wt in future.result():
+                    #Update score in teams
+                    if wt != None:
+                        teams[wt] += targs['points'][0]
+                        tournament_dict[r][group][wt] += targs['points'][0]
+                    else:
+                        teams[team_l] += targs['points'][1]
+                        teams[team_r] += targs['points'][1]
+                        tournament_dict[r][group][team_l] += targs['points'][1]
+                        tournament_dict[r][group][team_r] += targs['points'][1]
+                remaining[node] -= 1
+                if remaining[node] == 0:
+                    del remaining[node]
+                    finish(node)
+
+    return teams, tournament_dict
@@ -0,0 +1,149 @@
+"""
+Precomputed stopping boundaries of the sequential ranking rule.
+
+Both teams start from the same Beta(a, b) prior and observe the same number of games n, so
+whether the ranking stops only depends on n and on the won games z_a and z_b of each team.
+HDI lower bounds increase with the number of won games, so for each n and z the table keeps
+the smallest number of won games whose HDI lower bound is above the HDI upper bound of a team
+which won z games:
+    TeamA > TeamB  <=>  z_a >= thresholds[n, z_b]
+    TeamA < TeamB  <=>  z_b >= thresholds[n, z_a]
+Tables are saved to disk (one file per (a, b, confidence_mass)) and rebuilt when the
+parameters change or when more games than the stored table covers are requested.
+
+Usage: python stopping_table.py --a 2 --b 2 --cm 0.95 --mg 200
+"""
+
+import argparse
+import os
+import threading
+
+import numpy as np
+
+import hdi
+from utils import Dotdict
+
+class StoppingTable():
+    def __init__(self, a, b, confidence_mass, max_games, thresholds):
+        """
+        StoppingTable constructor:
+            a, b: Prior Beta distribution parameters of both teams (float > 0)
+            confidence_mass: HDIs' span (float 0 < x < 1)
+            max_games: Largest number of observed games covered by the table (int)
+            thresholds: Stopping thresholds indexed by [n, z] (numpy array)
+        """
+        self.a = a
+        self.b = b
+        self.confidence_mass = confidence_mass
+        self.max_games = max_games
+        self.thresholds = thresholds
+
+    def decide(self, a_a, b_a, a_b, b_b):
+        """
+        Stop/continue decision of the ranking rule for the posteriors Beta(a_a, b_a) and
+        Beta(a_b, b_b) of the two teams (floats or numpy arrays)
+
+        Return 1 if TeamA > TeamB, -1 if TeamA < TeamB, 0 to continue (int or numpy array)
+        """
+
+        a_a, b_a, a_b, b_b = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (a_a, b_a, a_b, b_b)))
+        n = a_a + b_a - self.a - self.b
+        z_a = a_a - self.a
+        z_b = a_b - self.a
+        #Posteriors the table does not cover are decided from their HDIs
+        in_table = ((n == np.round(n)) & (z_a == np.round(z_a)) & (z_b == np.round(z_b))
+                    & (n >= 0) & (n <= self.max_games) & (a_b + b_b == a_a + b_a)
+                    & (z_a >= 0) & (z_a <= n) & (z_b >= 0) & (z_b <= n))
+        n_i = np.where(in_table, n, 0).astype(int)
+        z_a_i = np.where(in_table, z_a, 0).astype(int)
+        z_b_i = np.where(in_table, z_b, 0).astype(int)
+        decision = np.where(z_a_i >= self.thresholds[n_i, z_b_i], 1, np.where(z_b_i >= self.thresholds[n_i, z_a_i], -1, 0))
+        if not in_table.all():
+            outside = ~in_table
+            low_a, up_a = hdi.beta_hdi_batch(a_a[outside], b_a[outside], self.confidence_mass)
+            low_b, up_b = hdi.beta_hdi_batch(a_b[outside], b_b[outside], self.confidence_mass)
+            decision[outside] = np.where(low_a > up_b, 1, np.where(up_a < low_b, -1, 0))
+        if decision.ndim == 0:
+            return int(decision)
+
+        return decision
+
+    def decide_teams(self, team_a, team_b):
+        """
+        Stop/continue decision for two Team objects (see decide)
+        """
+
+        return self.decide(team_a.a, team_a.b, team_b.a, team_b.b)
+
+    def save(self, path):
+        #Written aside then renamed, so that a reader never loads a partial table
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, thresholds=self.thresholds, params=np.array([self.a, self.b, self.confidence_mass, self.max_games]))
+        os.replace(tmp, path)
+
+def build(a, b, confidence_mass, max_games):
+    """
+    Compute the stopping table of the given configuration:
+        a, b: Prior Beta distribution parameters of both teams (float > 0)
+        confidence_mass: HDIs' span (float 0 < x < 1)
+        max_games: Largest number of observed games covered by the table (int)
+
+    Return the table (StoppingTable)
+    """
+
+    n, z = np.tril_indices(max_games + 1)
+    low, up = hdi.beta_hdi_batch(a + z, b + n - z, confidence_mass)
+    dtype = np.int16 if max_games < np.iinfo(np.int16).max else np.int32
+    thresholds = np.zeros((max_games + 1, max_games + 1), dtype=dtype)
+    start = 0
+    for games in range(max_games + 1):
+        stop = start + games + 1
+        #First number of won games whose lower bound is above each upper bound (games + 1 if none)
+        thresholds[games, :games + 1] = np.searchsorted(low[start:stop], up[start:stop], side='right')
+        start = stop
+
+    return StoppingTable(a, b, confidence_mass, max_games, thresholds)
+
+def table_path(a, b, confidence_mass, directory):
+    return os.path.join(directory, "stop_B{}_{}_{}.npz".format(a, b, confidence_mass))
+
+_loaded = {} #Tables loaded by this process, by (a, b, confidence_mass, directory)
+_lock = threading.Lock() #Concurrent rankings build a missing table once
+
+def load(a, b, confidence_mass, max_games, directory="tables"):
+    """
+    Load the stopping table of the given configuration from directory, building and saving
+    it if it does not exist, was computed for other parameters or covers less than max_games
+
+    Return the table (StoppingTable)
+    """
+
+    key = (a, b, confidence_mass, directory)
+    with _lock:
+        if key in _loaded and _loaded[key].max_games >= max_games: #Already loaded by this process
+            return _loaded[key]
+        path = table_path(a, b, confidence_mass, directory)
+        if os.path.exists(path):
+            with np.load(path) as f:
+                params = f['params']
+                if np.array_equal(params[:3], [a, b, confidence_mass]) and params[3] >= max_games:
+                    _loaded[key] = StoppingTable(a, b, confidence_mass, int(params[3]), f['thresholds'])
+                    return _loaded[key]
+        table = build(a, b, confidence_mass, max_games)
+        os.makedirs(directory, exist_ok=True)
+        table.save(path)
+        _loaded[key] = table
+
+    return table
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precompute the stopping boundaries of the Bayesian ranking rule")
+    parser.add_argument("--cm", type=float, default=0.95, help="Confidence mass")
+    parser.add_argument("--a", type=float, default=2, help="'a' parameter of the prior Beta distribution")
+    parser.add_argument("--b", type=float, default=2, help="'b' parameter of the prior Beta distribution")
+    parser.add_argument("--mg", type=int, default=200, help="Largest number of observed games covered by the table")
+    parser.add_argument("--tables", type=str, default="tables", help="Directory of the stopping tables")
+    args = Dotdict(vars(parser.parse_args()))
+    table = load(args.a, args.b, round(args.cm, 2), args.mg, args.tables)
+    print("Stopping table B(%g, %g), cm %g, up to %d games: %s"%(table.a, table.b, table.confidence_mass, table.max_games, table_path(args.a, args.b, round(args.cm, 2), args.tables)))
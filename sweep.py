@@ -0,0 +1,202 @@
+"""
+Parallel parameter sweep of the ranking rule for calibration studies.
+
+Runs the Monte Carlo trials of test_bayes_ranker.main_batch over the Cartesian grid of
+theta x prior (a, b) x confidence mass x prior games x batch size (games generated at once),
+spreading the grid cells over a pool of processes. Each cell draws its games from its own
+random generator, seeded from the sweep seed and the cell's parameters, so a cell gives the same
+row whatever the number of processes and the order the cells are run in. With --engine exact the
+rows are the exact expectations of the trials (see test_bayes_ranker.main_exact).
+
+Rows are written as soon as they are computed to CSV chunks of at most --chunk rows in the output
+directory (each chunk is written to a temporary file, then renamed), so memory stays bounded
+and an interrupted sweep resumes where it stopped: cells found in the existing chunks are not
+run again. The settings the rows depend on besides their cell (engine, mg, nbt and seed) are recorded
+in the output directory, a sweep with other settings is refused there rather than mixing rows.
+--merged gathers every chunk into a single CSV sorted by cell.
+
+Usage: python sweep.py --thetas 0:1:0.05 --priors 2:2,1:1 --cms 0.9,0.95 --pgs 0 --batches 1,5 --output sweep
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import glob
+import itertools
+import json
+import os
+import zlib
+
+import numpy as np
+
+from utils import Dotdict
+import test_bayes_ranker as tbr
+
+HEADER = ["A", "B", "Confidence mass", "Prior games", "Batch size", "Theta", "Avg. A", "Avg. B", "Avg. generation", "Ratio A winner"]
+KEY_COLUMNS = 6 #Columns identifying the cell of a row
+SETTINGS_FILE = "settings.json" #Settings of the sweep of an output directory
+
+def parse_values(text):
+    """
+    Parse "v1,v2,..." or "start:stop:step" (stop included) into a list of floats
+    """
+
+    if ':' in text and ',' not in text:
+        start, stop, step = (float(x) for x in text.split(':'))
+        return [round(x, 10) for x in np.arange(start, stop + step / 2, step)]
+
+    return [float(x) for x in text.split(',')]
+
+def parse_priors(text):
+    """
+    Parse "a:b,a:b,..." into a list of (a, b) tuples of floats
+    """
+
+    return [tuple(float(x) for x in prior.split(':')) for prior in text.split(',')]
+
+def cell_key(cell):
+    #Values of the key columns of a cell as written in the CSV
+    (a, b), cm, pg, nb_samples, theta = cell
+
+    return (repr(float(a)), repr(float(b)), repr(float(cm)), str(int(pg)), str(int(nb_samples)), repr(float(theta)))
+
+def grid(args):
+    """
+    Return the cells ((a, b), cm, pg, batch size, theta) of the sweep (list of tuple)
+    """
+
+    return list(itertools.product(parse_priors(args.priors), parse_values(args.cms), [int(x) for x in parse_values(args.pgs)],
+                                  [int(x) for x in parse_values(args.batches)], parse_values(args.thetas)))
+
+def run_cell(cell, nbt, mg, tables, seed, engine="batch"):
+    """
+    Run the nbt trials of a cell with its own random generator,
+    or compute their exact expectations with the exact engine
+
+    Return the CSV row of the cell (list)
+    """
+
+    (a, b), cm, pg, nb_samples, theta = cell
+    args = Dotdict(a=a, b=b, cm=cm, pg=pg, mg=mg, nb_samples=nb_samples, tables=tables)
+    if engine == "exact":
+        avg_a, avg_b, avg_games, p_a = tbr.main_exact(args, theta)[:4]
+
+        return list(cell_key(cell)) + [avg_a, avg_b, avg_games, p_a * 100]
+    rng = np.random.default_rng([seed, zlib.crc32(','.join(cell_key(cell)).encode())])
+    res_a, res_b, res_games, res_winner = tbr.main_batch(args, theta, nbt, rng)
+    ratio_winner_a = (np.count_nonzero(res_winner == 1) * 100) / nbt
+
+    return list(cell_key(cell)) + [res_a.mean(), res_b.mean(), res_games.mean(), ratio_winner_a]
+
+def done_cells(directory):
+    """
+    Return the keys of the cells found in the chunks of directory (set)
+    """
+
+    done = set()
+    for path in glob.glob(os.path.join(directory, "chunk_*.csv")):
+        with open(path, 'r') as f:
+            reader = csv.reader(f, delimiter=";")
+            next(reader, None)
+            for row in reader:
+                done.add(tuple(row[:KEY_COLUMNS]))
+
+    return done
+
+def check_settings(directory, args):
+    """
+    Record the settings of the sweep in directory, raise ValueError if it holds a sweep with other settings
+    """
+
+    settings = {"engine": args.engine, "mg": args.mg, "nbt": args.nbt if args.engine != "exact" else None,
+                "seed": args.seed if args.engine != "exact" else None}
+    path = os.path.join(directory, SETTINGS_FILE)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            stored = json.load(f)
+        if stored != settings:
+            raise ValueError("{} holds a sweep with other settings ({}), use another output directory".format(directory, stored))
+        return
+    with open(path, 'w') as f:
+        json.dump(settings, f)
+
+def write_chunk(directory, rows):
+    """
+    Write rows to the next chunk of directory
+    """
+
+    chunks = glob.glob(os.path.join(directory, "chunk_*.csv"))
+    index = max((int(os.path.basename(chunk)[6:-4]) for chunk in chunks), default=-1) + 1
+    path = os.path.join(directory, "chunk_%06d.csv"%(index))
+    with open(path + ".tmp", 'w') as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+    os.replace(path + ".tmp", path)
+
+def merge(directory, path):
+    """
+    Gather the chunks of directory into a single CSV at path, sorted by cell
+    """
+
+    rows = []
+    for chunk in sorted(glob.glob(os.path.join(directory, "chunk_*.csv"))):
+        with open(chunk, 'r') as f:
+            reader = csv.reader(f, delimiter=";")
+            next(reader, None)
+            rows.extend(reader)
+    rows.sort(key=lambda row: [float(x) for x in row[:KEY_COLUMNS]])
+    with open(path, 'w') as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+
+def main(args):
+    os.makedirs(args.output, exist_ok=True)
+    check_settings(args.output, args)
+    done = done_cells(args.output)
+    cells = [cell for cell in grid(args) if cell_key(cell) not in done]
+    print("%d cells to run, %d already done"%(len(cells), len(done)))
+    if args.tables: #Built once here rather than concurrently by the processes
+        for (a, b), cm, pg, nb_samples in set(cell[:4] for cell in cells):
+            tbr.stopping_table.load(a, b, round(cm, 2), (pg + args.mg + 1) * nb_samples, args.tables)
+    rows = []
+    jobs = args.jobs or os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = set()
+        cells = iter(cells)
+        while True:
+            #At most 2 cells per process in flight, so that memory stays bounded
+            for cell in itertools.islice(cells, 2 * jobs - len(pending)):
+                pending.add(pool.submit(run_cell, cell, args.nbt, args.mg, args.tables, args.seed, args.engine))
+            if not pending:
+                break
+            finished, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                rows.append(future.result())
+            if len(rows) >= args.chunk:
+                write_chunk(args.output, rows)
+                rows = []
+    if rows:
+        write_chunk(args.output, rows)
+    if args.merged:
+        merge(args.output, args.merged)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sweep the ranking rule over a grid of parameters on several processes")
+    parser.add_argument("--thetas", type=str, default="0:1:0.05", help="Thetas: comma separated values or start:stop:step")
+    parser.add_argument("--priors", type=str, default="2:2", help="Prior Beta distributions: comma separated a:b couples")
+    parser.add_argument("--cms", type=str, default="0.95", help="Confidence masses: comma separated values or start:stop:step")
+    parser.add_argument("--pgs", type=str, default="0", help="Numbers of prior games: comma separated values or start:stop:step")
+    parser.add_argument("--batches", type=str, default="1", help="Numbers of games generated at once: comma separated values or start:stop:step")
+    parser.add_argument("--mg", type=int, default=100, help="Maximal number of games (doesn't include prior games)")
+    parser.add_argument("--nbt", type=int, default=100, help="Number of test per cell")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the sweep, the generator of each cell is derived from it")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of processes (default: number of CPUs)")
+    parser.add_argument("--chunk", type=int, default=100, help="Number of rows per CSV chunk")
+    parser.add_argument("--output", type=str, default="sweep", help="Directory of the CSV chunks, an existing sweep in it is resumed")
+    parser.add_argument("--merged", type=str, default=None, help="Path of a single CSV gathering every chunk, sorted by cell")
+    parser.add_argument("--engine", type=str, default="batch", choices=["batch", "exact"], help="Run the Monte Carlo trials of each cell (batch) or compute their exact expectations (exact, --nbt and --seed are unused)")
+    parser.add_argument("--tables", type=str, default=None, help="Directory of the precomputed stopping tables (see stopping_table.py), HDIs are computed at each iteration if unset")
+    args = Dotdict(vars(parser.parse_args()))
+    main(args)
@@ -1,4 +1,10 @@
-import scipy
+import numpy as np
+import scipy.stats
+
+import hdi
+import metrics
+
+BATCH_MIN_TEAMS = 8 #Smaller updates use the cached scalar HDIs, faster than a vectorized computation
 
 class Team():
     def __init__(self, a, b, confidence_mass, name, path):
@@ -12,29 +18,44 @@ class Team():
         self.a = a
         self.b = b
         self.confidence_mass = confidence_mass
-        self.distrib = scipy.stats.beta(a, b)
-        self.hdi = self.get_hdi()
-        self.up_bound = self.hdi[1]
-        self.low_bound = self.hdi[0]
+        self._hdi = None #Computed on demand, reset by update
         self.name = name
         self.path = path
 
-    def get_hdi(self):
+    @property
+    def distrib(self):
         """
-        Compute the Highest Density Interval of the team's distribution:
-        Adapted from: https://stackoverflow.com/questions/22284502/highest-posterior-density-region-and-central-credible-region
+        Frozen scipy Beta distribution of the team's parameter (built on demand)
         """
-        inconfidence_mass = 1 - self.confidence_mass
 
-        def get_interval_width(low_tail):
-            interval_width = self.distrib.ppf(self.confidence_mass + low_tail) - self.distrib.ppf(low_tail)
+        return scipy.stats.beta(self.a, self.b)
+
+    @property
+    def hdi(self):
+        """
+        Highest Density Interval of the team's distribution, computed on first access
+        """
+
+        if self._hdi is None:
+            self._hdi = self.get_hdi()
+
+        return self._hdi
+
+    @property
+    def low_bound(self):
+        return self.hdi[0]
 
-            return interval_width
+    @property
+    def up_bound(self):
+        return self.hdi[1]
 
-        hdi_low_tail = scipy.optimize.fmin(get_interval_width, inconfidence_mass, ftol=1e-8, disp=False)[0]
-        hdi = self.distrib.ppf([hdi_low_tail, self.confidence_mass + hdi_low_tail])
+    def get_hdi(self):
+        """
+        Compute the Highest Density Interval of the team's distribution (see hdi.beta_hdi)
+        """
 
-        return hdi
+        with metrics.timer("hdi"):
+            return hdi.beta_hdi(self.a, self.b, self.confidence_mass)
 
     def update(self, n, z):
         """
@@ -44,7 +65,45 @@ class Team():
         """
         self.a += z
         self.b += n - z
-        self.distrib = scipy.stats.beta(self.a, self.b)
-        self.hdi = self.get_hdi()
-        self.up_bound = self.hdi[1]
-        self.low_bound = self.hdi[0]
+        self._hdi = None
+
+def update_teams(teams, n, z, compute_hdi=True):
+    """
+    Update the Beta distributions of several teams (a single vectorized HDI computation from BATCH_MIN_TEAMS teams):
+        teams: Teams to update (list of Team)
+        n: number of observed games (int, or one int per team)
+        z: number of won games (one int per team)
+        compute_hdi: Compute the HDIs now, otherwise on first access (bool)
+    """
+
+    n = np.broadcast_to(n, len(teams))
+    for t, games, won in zip(teams, n, z):
+        t.update(games, won)
+    if not compute_hdi:
+        return
+    if len(teams) < BATCH_MIN_TEAMS:
+        for t in teams:
+            t._hdi = t.get_hdi()
+        return
+    metrics.count("hdi_batch_posteriors", len(teams))
+    with metrics.timer("hdi"):
+        lows, ups = hdi.beta_hdi_batch([t.a for t in teams], [t.b for t in teams], [t.confidence_mass for t in teams])
+    for t, low, up in zip(teams, lows, ups):
+        t._hdi = (float(low), float(up))
+
+def compare(team_a, team_b, table=None):
+    """
+    Rank two teams according to their HDIs:
+        table: Precomputed stopping boundaries replacing the HDI computations (StoppingTable)
+
+    Return 1 if team_a > team_b, -1 if team_a < team_b, 0 if the HDIs overlap (int)
+    """
+
+    if table is not None:
+        return table.decide_teams(team_a, team_b)
+    if team_a.low_bound > team_b.up_bound:
+        return 1
+    if team_a.up_bound < team_b.low_bound:
+        return -1
+
+    return 0
@@ -12,62 +12,16 @@ Refer to: John K. Kruschke, Bayesian estimation supersedes the t test, Journal o
 """
 
 import scipy.stats
-import scipy.optimize
 import argparse
 import numpy as np
 import csv
+import functools
 from tqdm import tqdm
 
 from utils import Dotdict
-
-class Team():
-    def __init__(self, a, b, confidence_mass, name, path):
-        """
-        Team constructor:
-            a, b: Initial Beta distribution parameters (float > 0)
-            confidence_mass: Highest Density Interval (HDI)'s span (float 0 < x < 1)
-            name: Team name (string)
-            path: path to the team's script
-        """
-        self.a = a
-        self.b = b
-        self.confidence_mass = confidence_mass
-        self.distrib = scipy.stats.beta(a, b)
-        self.hdi = self.get_hdi()
-        self.up_bound = self.hdi[1]
-        self.low_bound = self.hdi[0]
-        self.name = name
-        self.path = path
-
-    def get_hdi(self):
-        """
-        Compute the Highest Density Interval of the team's distribution:
-        Adapted from: https://stackoverflow.com/questions/22284502/highest-posterior-density-region-and-central-credible-region
-        """
-        inconfidence_mass = 1 - self.confidence_mass
-
-        def get_interval_width(low_tail):
-            interval_width = self.distrib.ppf(self.confidence_mass + low_tail) - self.distrib.ppf(low_tail)
-
-            return interval_width
-
-        hdi_low_tail = scipy.optimize.fmin(get_interval_width, inconfidence_mass, ftol=1e-8, disp=False)[0]
-        hdi = self.distrib.ppf([hdi_low_tail, self.confidence_mass + hdi_low_tail])
-
-        return hdi
-
-    def update(self, n, z):
-        """
-        Update the Beta distribution:
-            n: number of observed games
-            z: number of won games
-        """
-        self.a += z
-        self.b += n - z
-        self.distrib = scipy.stats.beta(self.a, self.b)
-        self.hdi = self.get_hdi()
-        self.up_bound = self.hdi[1]
-        self.low_bound = self.hdi[0]
+from team import Team, update_teams, compare
+import hdi
+import stopping_table
 
 def generate_game(theta, nb_samples):
     """
@@ -99,6 +53,9 @@ def main(args, theta):
     games = 0
     ranked = False
     winner = None
+    table = None
+    if args.tables:
+        table = stopping_table.load(a, b, confidence_mass, (prior_games + max_game + 1) * args.nb_samples, args.tables)
 
     #Build the two teams
     team_a = Team(a, b, confidence_mass, "TeamA", "")
@@ -107,21 +64,20 @@ def main(args, theta):
     #Make some prior simulations
     for i in range(prior_games):
         score_team_a, score_team_b = generate_game(theta, args.pg)
-        team_a.update(args.nb_samples, score_team_a)
-        team_b.update(args.nb_samples, score_team_b)
+        update_teams([team_a, team_b], args.nb_samples, [score_team_a, score_team_b], table is None)
 
     #Start the ranking algorithm
     while not ranked:
-        if team_a.low_bound > team_b.up_bound: #TeamA > TeamB
+        decision = compare(team_a, team_b, table)
+        if decision == 1: #TeamA > TeamB
             winner = team_a
             ranked = True
-        elif team_a.up_bound < team_b.low_bound: #TeamA < TeamB
+        elif decision == -1: #TeamA < TeamB
             winner = team_b
             ranked = True
         elif games < max_game: #Too much uncertainty, observe one additional game
             score_team_a, score_team_b = generate_game(theta, args.nb_samples)
-            team_a.update(args.nb_samples, score_team_a)
-            team_b.update(args.nb_samples, score_team_b)
+            update_teams([team_a, team_b], args.nb_samples, [score_team_a, score_team_b], table is None)
             games += 1
         else: #Too much uncertainty, but simulations number limit reached
             score_team_a, score_team_b = generate_game(theta, args.nb_samples)
@@ -135,6 +91,217 @@ def main(args, theta):
 
     return [theta, team_a.a - 2, team_b.a - 2, games, winner.name]
 
+def batch_hdi(a, b, confidence_mass):
+    """
+    HDIs of arrays of Beta distributions, computed once per distinct (a, b) couple
+    """
+
+    states, inverse = np.unique(np.stack([a, b], axis=1), axis=0, return_inverse=True)
+    low, up = hdi.beta_hdi_batch(states[:, 0], states[:, 1], confidence_mass)
+    inverse = inverse.reshape(-1)
+
+    return low[inverse], up[inverse]
+
+def main_batch(args, theta, nbt, rng=None):
+    """
+    Run nbt trials of the ranking rule of main at once:
+    every trial is a row of NumPy arrays of Beta parameters and trials which are ranked
+    are masked out while the others observe additional games.
+        nbt: Number of trials (int)
+        rng: Random generator (numpy.random.Generator)
+
+    Return the won games of A and B minus 2 (as main does), the number of games and
+    the winner of each trial, 1 for A, -1 for B and 0 for none (tuple of numpy arrays)
+    """
+    #Global variables
+    confidence_mass = round(args.cm, 2) #Runtime error occurs on the numpy side for numbers not rounded to 2
+    assert (confidence_mass > 0 and confidence_mass < 1), "The confidence mass should be a number between 0 and 1"
+    prior_games = args.pg
+    assert (prior_games >= 0), "The number of prior games should be greater or equal than 0"
+    max_game = args.mg
+    assert (max_game >= 0), "The maximal number of games shoud be positive"
+    a = args.a
+    b = args.b
+    assert (a > 0 and b > 0), "A Beta distribution is only defined for parameters greater than 0"
+    if rng is None:
+        rng = np.random.default_rng()
+    nb_samples = args.nb_samples
+    a_a = np.full(nbt, float(a))
+    b_a = np.full(nbt, float(b))
+    a_b = np.full(nbt, float(a))
+    b_b = np.full(nbt, float(b))
+    games = np.zeros(nbt, dtype=int)
+    winner = np.zeros(nbt, dtype=int)
+    active = np.ones(nbt, dtype=bool)
+    table = None
+    if args.tables:
+        table = stopping_table.load(a, b, confidence_mass, (prior_games + max_game + 1) * nb_samples, args.tables)
+
+    #Make some prior simulations
+    for i in range(prior_games):
+        score_team_a = rng.binomial(args.pg, theta, nbt)
+        a_a += score_team_a
+        b_a += nb_samples - score_team_a
+        a_b += args.pg - score_team_a
+        b_b += nb_samples - (args.pg - score_team_a)
+
+    #Start the ranking algorithm
+    while active.any():
+        idx = np.flatnonzero(active)
+        if table is not None:
+            winner[idx] = table.decide(a_a[idx], b_a[idx], a_b[idx], b_b[idx])
+        else:
+            low, up = batch_hdi(np.concatenate([a_a[idx], a_b[idx]]), np.concatenate([b_a[idx], b_b[idx]]), confidence_mass)
+            low_a, low_b = np.split(low, 2)
+            up_a, up_b = np.split(up, 2)
+            winner[idx[low_a > up_b]] = 1 #TeamA > TeamB
+            winner[idx[up_a < low_b]] = -1 #TeamA < TeamB
+        undecided = idx[winner[idx] == 0]
+        active[idx] = False
+        #Too much uncertainty, observe one additional game
+        more = undecided[games[undecided] < max_game]
+        decisive = undecided[games[undecided] >= max_game]
+        score_team_a = rng.binomial(nb_samples, theta, len(more))
+        a_a[more] += score_team_a
+        b_a[more] += nb_samples - score_team_a
+        a_b[more] += nb_samples - score_team_a
+        b_b[more] += score_team_a
+        games[more] += 1
+        active[more] = True
+        #Too much uncertainty, but simulations number limit reached
+        score_team_a = rng.binomial(nb_samples, theta, len(decisive))
+        winner[decisive] = np.sign(2 * score_team_a - nb_samples)
+
+    return a_a - 2, a_b - 2, games, winner
+
+@functools.lru_cache(maxsize=16)
+def exact_decisions(a, b, confidence_mass, prior_games, nb_samples, max_game, tables):
+    """
+    Decisions of the ranking rule of main_batch on the (games, won games of A) lattice.
+    They do not depend on theta, so they are computed once for every theta.
+
+    Return, for each number of games k in [0, max_game], the decision (1 if TeamA > TeamB,
+    -1 if TeamA < TeamB, 0 to continue) for each number of won games of A (list of numpy arrays)
+    """
+
+    table = None
+    if tables:
+        table = stopping_table.load(a, b, confidence_mass, (prior_games + max_game + 1) * nb_samples, tables)
+    decisions = []
+    for k in range(max_game + 1):
+        #The posteriors of main_batch after k games only depend on the total won games of A
+        won = np.arange(prior_games * prior_games + k * nb_samples + 1, dtype=float)
+        a_a = a + won
+        b_a = b + (prior_games + k) * nb_samples - won
+        a_b = a + prior_games * prior_games + k * nb_samples - won
+        b_b = b + prior_games * nb_samples - prior_games * prior_games + won
+        if table is not None:
+            decision = table.decide(a_a, b_a, a_b, b_b)
+        else:
+            low, up = batch_hdi(np.concatenate([a_a, a_b]), np.concatenate([b_a, b_b]), confidence_mass)
+            low_a, low_b = np.split(low, 2)
+            up_a, up_b = np.split(up, 2)
+            decision = np.where(low_a > up_b, 1, np.where(up_a < low_b, -1, 0))
+        decisions.append(decision)
+
+    return decisions
+
+def main_exact(args, theta):
+    """
+    Exact operating characteristics of the ranking rule of main_batch: instead of sampling trials,
+    the probability of every state (games, won games of A) is propagated game after game until
+    max_game, the mass of the states where the rule stops being set aside.
+
+    Return the expected won games of A and B minus 2 (as main does), the expected number of games,
+    the probabilities that A wins, that B wins and of no winner, and the stopping states as
+    (games, won games of A, winner, probability) rows (tuple)
+    """
+    #Global variables
+    confidence_mass = round(args.cm, 2) #Runtime error occurs on the numpy side for numbers not rounded to 2
+    assert (confidence_mass > 0 and confidence_mass < 1), "The confidence mass should be a number between 0 and 1"
+    prior_games = args.pg
+    assert (prior_games >= 0), "The number of prior games should be greater or equal than 0"
+    max_game = args.mg
+    assert (max_game >= 0), "The maximal number of games shoud be positive"
+    a = args.a
+    b = args.b
+    assert (a > 0 and b > 0), "A Beta distribution is only defined for parameters greater than 0"
+    nb_samples = args.nb_samples
+    decisions = exact_decisions(a, b, confidence_mass, prior_games, nb_samples, max_game, args.tables)
+    game = scipy.stats.binom.pmf(np.arange(nb_samples + 1), nb_samples, theta) #Won games of A in one generation
+    #Prior simulations: prior_games draws of prior_games games each, as main does
+    mass = scipy.stats.binom.pmf(np.arange(prior_games * prior_games + 1), prior_games * prior_games, theta)
+    avg_a = avg_b = avg_games = 0
+    winners = {1: 0, -1: 0, 0: 0}
+    states = []
+
+    def stop(k, won, probability, winner):
+        #Set aside the mass of stopping states
+        nonlocal avg_a, avg_b, avg_games
+        avg_a += (probability * (a + won - 2)).sum()
+        avg_b += (probability * (a + prior_games * prior_games + k * nb_samples - won - 2)).sum()
+        avg_games += probability.sum() * k
+        winners[winner] += probability.sum()
+        states.extend((k, w, winner, p) for w, p in zip(won, probability) if p > 0)
+
+    for k in range(max_game + 1):
+        won = np.arange(len(mass))
+        for winner in (1, -1):
+            ranked = decisions[k] == winner
+            stop(k, won[ranked], mass[ranked], winner)
+        mass = np.where(decisions[k] == 0, mass, 0)
+        if k < max_game: #Too much uncertainty, observe one additional game
+            mass = np.convolve(mass, game)
+    #Too much uncertainty, but simulations number limit reached: a decisive generation
+    undecided = mass > 0
+    for winner, p in ((1, game[2 * np.arange(nb_samples + 1) > nb_samples].sum()),
+                      (-1, game[2 * np.arange(nb_samples + 1) < nb_samples].sum()),
+                      (0, game[2 * np.arange(nb_samples + 1) == nb_samples].sum())):
+        stop(max_game, won[undecided], mass[undecided] * p, winner)
+
+    return avg_a, avg_b, avg_games, winners[1], winners[-1], winners[0], states
+
+def run_theta(args, theta):
+    """
+    Run args.nbt trials for theta with the engine selected by args.engine
+    (the exact engine computes the expectations the trials estimate)
+
+    Return the CSV row of theta: [theta, avg. A, avg. B, avg. generation, ratio A winner]
+    """
+
+    if args.engine == "exact":
+        avg_a, avg_b, avg_games, p_a, p_b, p_none, states = main_exact(args, theta)
+        #Wrong decisions: the weaker team (or any team for equal strengths) ranked first
+        error = p_b if theta > 0.5 else p_a if theta < 0.5 else p_a + p_b
+        print("Error rate: %f, no winner: %f"%(error, p_none))
+        if args.distributions:
+            with open(args.distributions, "a") as f:
+                writer = csv.writer(f, delimiter=";")
+                writer.writerows([theta] + list(state) for state in states)
+
+        return [theta, avg_a, avg_b, avg_games, p_a * 100]
+    if args.engine == "batch":
+        res_a, res_b, res_games, res_winner = main_batch(args, theta, args.nbt)
+        ratio_winner_a = (np.count_nonzero(res_winner == 1) * 100) / args.nbt
+
+        return [theta, res_a.mean(), res_b.mean(), res_games.mean(), ratio_winner_a]
+    avg_a = []
+    avg_b = []
+    avg_games = []
+    ratio_winner_a = []
+    for i in tqdm(range(args.nbt)):
+        res = main(args, theta)
+        avg_a.append(res[1])
+        avg_b.append(res[2])
+        avg_games.append(res[3])
+        ratio_winner_a.append(res[4])
+    avg_a = sum(avg_a) / len(avg_a)
+    avg_b = sum(avg_b) / len(avg_b)
+    avg_games = sum(avg_games) / len(avg_games)
+    ratio_winner_a = (ratio_winner_a.count("TeamA") * 100) / args.nbt
+
+    return [theta, avg_a, avg_b, avg_games, ratio_winner_a]
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Rank 2 RoboCup Simulation 2D teams according to Bayesian inference")
     parser.add_argument("--cm", type=float, default=0.95, help="Confidence mass")
@@ -145,27 +312,20 @@ if __name__ == '__main__':
     parser.add_argument("--nbt", type=int, default=100, help="Number of test per theta")
     parser.add_argument("--step", type=float, default=0.05, help="Theta range's step")
     parser.add_argument("--nb_samples", type=int, default=1, help="Number of games generated at once")
+    parser.add_argument("--engine", type=str, default="batch", choices=["batch", "sequential", "exact"], help="Run the tests of a theta together as NumPy arrays (batch), one after another (sequential) or compute their exact expectations (exact)")
+    parser.add_argument("--tables", type=str, default=None, help="Directory of the precomputed stopping tables (see stopping_table.py), HDIs are computed at each iteration if unset")
+    parser.add_argument("--distributions", type=str, default=None, help="With the exact engine, CSV of the probability of each stopping state (games, won games of A, winner) per theta")
     args = Dotdict(vars(parser.parse_args()))
+    if args.distributions:
+        with open(args.distributions, "w") as f:
+            csv.writer(f, delimiter=";").writerow(["Theta", "Games", "Won A", "Winner", "Probability"])
     to_test = np.arange(0.0, 1.0 + args.step, args.step)
     csv_content = [["Theta", "Avg. A", "Avg. B", "Avg. generation", "Ratio A winner"]]
     for theta in to_test:
         print("Testing theta: %f ..."%(theta))
-        avg_a = []
-        avg_b = []
-        avg_games = []
-        ratio_winner_a = []
-        for i in tqdm(range(args.nbt)):
-            res = main(args, theta)
-            avg_a.append(res[1])
-            avg_b.append(res[2])
-            avg_games.append(res[3])
-            ratio_winner_a.append(res[4])
-        avg_a = sum(avg_a) / len(avg_a)
-        avg_b = sum(avg_b) / len(avg_b)
-        avg_games = sum(avg_games) / len(avg_games)
-        ratio_winner_a = (ratio_winner_a.count("TeamA") * 100) / args.nbt
-        csv_content.append([theta, avg_a, avg_b, avg_games, ratio_winner_a])
-        print([theta, avg_a, avg_b, avg_games, ratio_winner_a])
+        row = run_theta(args, theta)
+        csv_content.append(row)
+        print(row)
     with open("B%d%d_%d_%d_%f_%d_tests.csv"%(args.a, args.b, args.pg, args.nb_samples, args.step, args.nbt), "w") as f:
         writer = csv.writer(f, delimiter=";")
         for elt in csv_content:
@@ -1,118 +1,163 @@
 import json
+import os
+import functools
 from operator import itemgetter
-import argparse
 
+from utils import Dotdict
 import bayes_ranker as br
+import bradley_terry as bt
+import active
+import backends
+import robocup_utils as rc
+import scheduler
+import metrics
+import match_store as ms
+from journal import Journal
+from evidence import EvidenceCache, POLICIES
+
+SETTINGS = 'tournaments/2016.json'
+
+@functools.lru_cache(maxsize=None)
+def load_settings(path):
+    """
+    Load tournament settings, kept in memory for the next tournaments of the process (dict)
+    """
+
+    with open(path, 'r') as f:
+        return json.load(f)
 
 def main(args):
     #Loads tournament settings
-    with open('tournaments/2016.json', 'r') as f:
-        targs = json.load(f)
+    targs = load_settings(SETTINGS)
     #some variables
     rounds = ['seeds', 'preliminary-rounds', 'pre-qualifying-rounds', 'post-qualifying-rounds', 'consolation-playoff', 'semi-finals', 'final-playoff']
-    teams = {t:0 for t in targs['teams']}
-    tournament_dict = {}
-    ##Seed tournament
-    seed_dict = {}
-    for group in sorted(targs['seeds']):
-        l = len(targs['seeds'][group])
-        seed_dict[group] = {i:0 for i in targs['seeds'][group]} #Create a dictionnary representing the ranking inside the groups
-        #Run Bayesian ranker for each possible couple of teams in the group
-        print(seed_dict)
-        for i in range(l):
-            for j in range(i + 1, l):
-                team_l = targs['seeds'][group][i]
-                team_r = targs['seeds'][group][j]
-                bin_team_l = targs['teams'][team_l]
-                bin_team_r = targs['teams'][team_r]
-                args.lb = bin_team_l
-                args.ln = team_l
-                args.rb = bin_team_r
-                args.rn = team_r
-                #Call Bayesian ranker
-                wt = br.main(args)
-                #Update score in teams
-                if wt != None:
-                    teams[wt.name] += targs['points'][0]
-                    seed_dict[group][wt.name] += targs['points'][0]
-                else:
-                    teams[team_l] += targs['points'][1]
-                    teams[team_r] += targs['points'][1]
-                    seed_dict[group][team_l] += targs['points'][1]
-                    seed_dict[group][team_r] += targs['points'][1]
-    tournament_dict['seeds'] = seed_dict
-    #Write seeds ranking in files
-    for s in tournament_dict['seeds']:
-        with open('textres/seeds_{}'.format(s), 'w') as f:
-            sort = sorted(tournament_dict['seeds'][s].items(), key=itemgetter(1), reverse=True)
-            for so in sort:
+    jobs = args.jobs or 1
+    assert (args.budget is None or args.engine in ("bradley_terry", "active")), "A game budget needs the active or bradley_terry engine"
+    output = args.output or "textres"
+    os.makedirs(output, exist_ok=True)
+
+    journal = Journal(args.journal) if args.journal else None
+    evidence = EvidenceCache(args.carry, args.carry_weight, args.carry_max) if args.carry and args.carry != "none" else None
+    if journal is not None and evidence is not None:
+        #Pairings finished before a restart are not played again: their games are the evidence of the later rounds.
+        #The games of unfinished pairings are recorded as they are replayed
+        for (r, group, team_l, team_r), games in journal.games.items():
+            if (r, group, team_l, team_r) in journal.results:
+                for match_id, score, log in games:
+                    evidence.record((team_l, targs['teams'][team_l]), (team_r, targs['teams'][team_r]), score, match_id)
+    budget = active.Budget(args.budget, sum(len(g) * (len(g) - 1) // 2 for r in rounds for g in targs[r].values()))
+
+    def pair_backend(r, group, team_l, team_r, slot):
+        #Each concurrent pair gets its own copy of the arguments and its own server ports
+        pair_args = Dotdict(args)
+        pair_args.lb = targs['teams'][team_l]
+        pair_args.ln = team_l
+        pair_args.rb = targs['teams'][team_r]
+        pair_args.rn = team_r
+        pair_args.stream = (r, group) #A rematch in a later round plays new synthetic games
+        pair_args.stage = "{}/{}".format(r, group) #and does not replay the stored games its carried evidence holds
+        if jobs > 1:
+            pair_args.port = (args.port or rc.DEFAULT_PORT) + slot * max(args.workers or 1, 1) * rc.PORT_STRIDE
+        backend = backends.make_backend(pair_args)
+        if journal is not None:
+            backend = journal.backend((r, group, team_l, team_r), backend)
+        if evidence is not None:
+            backend = evidence.backend((team_l, pair_args.lb), (team_r, pair_args.rb), backend)
+
+        return pair_args, backend
+
+    def rank_pair(r, group, team_l, team_r, slot):
+        key = (r, group, team_l, team_r)
+        if journal is not None and key in journal.results: #Finished before a restart
+            return journal.results[key]
+        pair_args, backend = pair_backend(r, group, team_l, team_r, slot)
+        prior = None
+        if evidence is not None: #The teams may have met in an earlier round
+            sides = ((team_l, pair_args.lb), (team_r, pair_args.rb))
+            decision = evidence.decision(*sides, round(args.cm, 2))
+            if decision is not None:
+                winner = team_l if decision == 1 else team_r
+                print("%s vs %s: reused the decision of an earlier round, winner: %s"%(team_l, team_r, winner))
+                if journal is not None:
+                    journal.record_result(key, winner)
+                return winner
+            prior = evidence.prior(*sides)
+        #Call Bayesian ranker
+        wt = br.main(pair_args, backend, prior)
+        winner = wt.name if wt != None else None
+        if journal is not None:
+            journal.record_result(key, winner)
+
+        return winner
+
+    def rank_group(r, group, teams_group, slot):
+        keys = [(r, group, teams_group[i], teams_group[j]) for i in range(len(teams_group)) for j in range(i + 1, len(teams_group))]
+        if journal is not None and all(key in journal.results for key in keys): #Finished before a restart
+            return [(key[2], key[3], journal.results[key]) for key in keys]
+        store = ms.MatchStore(args.store, "{}/{}".format(r, group)) if args.store else None
+        paths = [targs['teams'][t] for t in teams_group]
+
+        def backend_for(i, j):
+            return pair_backend(r, group, teams_group[i], teams_group[j], slot)[1]
+
+        if args.engine == "active": #Pairwise rankings sharing the games of the group
+            results, games = active.rank_group(teams_group, paths, backend_for, round(args.cm, 2), args.group_games, args.pg + args.mt,
+                                               max(args.workers or 1, 1), args.priority, budget.share(len(keys)), store)
+        else: #Joint Bradley-Terry ranking of the whole group
+            results, games = bt.rank_group(teams_group, paths, backend_for, round(args.cm, 2), args.group_games, args.pg, args.pg + args.mt, store,
+                                           budget.share(len(keys)))
+        if store is not None:
+            store.close()
+        if journal is not None:
+            for team_l, team_r, winner in results:
+                journal.record_result((r, group, team_l, team_r), winner)
+
+        return results
+
+    def write_group(r, group, scores):
+        #Write group ranking in a file
+        print('{} {} finished'.format(r, group))
+        with open(os.path.join(output, '{}_{}'.format(r, group)), 'w') as f:
+            for so in scheduler.ranking(scores):
                 f.write('{}\t{}\n'.format(so[0], so[1]))
-    ##Process each round
-    for r in range(1, len(rounds)):
-        print('------')
-        print(rounds[r])
-        print('------')
-        round_dict = {}
-        for group in sorted(targs[rounds[r]]):
-            teams_group = [t for t in targs[rounds[r]][group]] #Round_Group_Rank specified teams
-            #Fetch teams
-            tmp = []
-            for t in teams_group:
-                split = t.split('_')
-                team = sorted(tournament_dict[split[0]][split[1]].items(), key=itemgetter(1), reverse=True)[int(split[2]) - 1][0]
-                tmp.append(team)
-            print(teams_group)
-            round_dict[group] = {t:0 for t in tmp}
-            teams_group = [k for k in round_dict[group].keys()]
-            l = len(teams_group)
-            #Run Bayesian ranker for each possible couple of teams in the group
-            for i in range(l):
-                for j in range(i + 1, l):
-                    team_l = teams_group[i]
-                    team_r = teams_group[j]
-                    bin_team_l = targs['teams'][team_l]
-                    bin_team_r = targs['teams'][team_r]
-                    args.lb = bin_team_l
-                    args.ln = team_l
-                    args.rb = bin_team_r
-                    args.rn = team_r
-                    #Call Bayesian ranker
-                    wt = br.main(args)
-                    #Update score in teams
-                    if wt != None:
-                        teams[wt.name] += targs['points'][0]
-                        round_dict[group][wt.name] += targs['points'][0]
-                    else:
-                        teams[team_l] += targs['points'][1]
-                        teams[team_r] += targs['points'][1]
-                        round_dict[group][team_l] += targs['points'][1]
-                        round_dict[group][team_r] += targs['points'][1]
-        tournament_dict[rounds[r]] = round_dict
-        #Write groups ranking in files
-        for s in tournament_dict[rounds[r]]:
-            with open('textres/{}_{}'.format(rounds[r], s), 'w') as f:
-                sort = sorted(tournament_dict[rounds[r]][s].items(), key=itemgetter(1), reverse=True)
-                for so in sort:
-                    f.write('{}\t{}\n'.format(so[0], so[1]))
+
+    with metrics.timer("tournament"):
+        teams, tournament_dict = scheduler.run(targs, rounds, rank_pair, jobs, write_group, rank_group if args.engine in ("bradley_terry", "active") else None)
+    if journal is not None:
+        journal.close()
     #Print the final ranking
     print(sorted(teams.items(), key=itemgetter(1), reverse=True))
     #Write the final ranking into a file
-    with open('textres/final', 'w') as f:
+    with open(os.path.join(output, 'final'), 'w') as f:
         for t in sorted(teams.items(), key=itemgetter(1), reverse=True):
             f.write('{}\t{}\n'.format(t[0], t[1]))
 
+    return sorted(teams.items(), key=itemgetter(1), reverse=True)
+
+def arguments():
+    """
+    Return the command line parser, its defaults are the settings of a tournament (argparse.ArgumentParser)
+    """
+
+    parser = br.arguments()
+    parser.description = "Rank RoboCup Simulation 2D teams in a tournament of pairwise Bayesian rankings"
+    parser.add_argument("--journal", type=str, default=None, help="Path to the journal of the played games, a restarted tournament resumes from it")
+    parser.add_argument("--engine", type=str, default="pairwise", choices=["pairwise", "bradley_terry", "active"], help="Rank each pair of a group independently, all the teams of a group with a joint Bradley-Terry model, or each pair with the group's games going to the most uncertain pairs")
+    parser.add_argument("--priority", type=str, default="information", choices=["information", "overlap"], help="Pair getting the next games (active engine): largest expected HDI overlap reduction or largest HDI overlap")
+    parser.add_argument("--budget", type=int, default=None, help="Total number of games of the tournament (active and bradley_terry engines), pairs not separated when it is spent are draws")
+    parser.add_argument("--group_games", type=int, default=2, help="Games of each pair in the first round robin of a group (bradley_terry and active engines)")
+    parser.add_argument("--carry", type=str, default="none", choices=POLICIES, help="Evidence of earlier pairings of the same teams carried over (pairwise engine): nothing, their decision if still valid, or also their games")
+    parser.add_argument("--carry_weight", type=float, default=1.0, help="Weight of a game carried over from an earlier pairing (evidence policy)")
+    parser.add_argument("--carry_max", type=int, default=None, help="Maximal number of games carried over from earlier pairings (evidence policy)")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of pairwise rankings run simultaneously")
+    parser.add_argument("--output", type=str, default="textres", help="Directory of the group and final rankings")
+
+    return parser
+
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Rank 2 RoboCup Simulation 2D teams according to Bayesian inference")
-    parser.add_argument("--lb", type=str, default="/home/scom/Documents/robocup/environment/helios-10Singapore/start.sh", help="Path of the left team's script")
-    parser.add_argument("--ln", type=str, default="Helios2010", help="Name of the left team")
-    parser.add_argument("--rb", type=str, default="/home/scom/Documents/robocup/environment/agent2d-3.1.1/src/start.sh", help="Path of the right team's script")
-    parser.add_argument("--rn", type=str, default="Agent2D", help="Name of the right team")
-    parser.add_argument("--cm", type=float, default=0.95, help="Confidence mass")
-    parser.add_argument("--pg", type=int, default=10, help="Number of prior games")
-    parser.add_argument("--mt", type=int, default=10, help="Maximal number of tries (results in tries * prior games) (doesn't include first prior games)")
-    parser.add_argument("--a", type=float, default=2, help="'a' parameter of the prior Beta distribution")
-    parser.add_argument("--b", type=float, default=2, help="'b' parameter of the prior Beta distribution")
-    parser.add_argument("--fastm", type=bool, default=True, help="Boolean controling simulation fast mode")
-    parser.add_argument("--logdir", type=str, default="logs", help="Path to the directory for storing resulting log files")
-    args = Dotdict(vars(parser.parse_args()))
+    args = Dotdict(vars(arguments().parse_args()))
+    if args.metrics:
+        metrics.enable()
     main(args)
+    if args.metrics:
+        metrics.write(args.metrics)
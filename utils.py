@@ -1,3 +1,5 @@
+import argparse
+
 class Dotdict(dict):
      """
      dot.notation access to dictionary attributes